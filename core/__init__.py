@@ -1,16 +1,20 @@
-import pkgutil
 import os
 import sys
+import json
+import zlib
+import functools
 import cpm
 from collections import defaultdict
 from argparse import (
     _AppendConstAction, _CountAction, _StoreConstAction, _SubParsersAction,
 )
 from importlib import import_module
+from importlib.machinery import all_suffixes
 from difflib import get_close_matches
 from cpm.core.base import (
     BaseCommand, CommandParser, CommandError,
 )
+from cpm.utils.config import default_cache_dir
 from cpm.utils.exceptions import ImproperlyConfigured
 
 
@@ -20,8 +24,18 @@ def find_commands(core_dir):
     names that are available.
     """
     command_dir = os.path.join(core_dir, 'commands')
-    return [name for _, name, is_pkg in pkgutil.iter_modules([command_dir])
-            if not is_pkg and not name.startswith('_')]
+    # a directory scan rather than pkgutil.iter_modules(), which imports inspect
+    suffixes = all_suffixes()
+    names = set()
+    with os.scandir(command_dir) as entries:
+        for entry in entries:
+            for suffix in suffixes:
+                if entry.name.endswith(suffix) and entry.is_file():
+                    name = entry.name[:-len(suffix)]
+                    if name.isidentifier() and not name.startswith('_'):
+                        names.add(name)
+                    break
+    return sorted(names)
 
 
 def load_command_class(app_name, name):
@@ -29,7 +43,14 @@ def load_command_class(app_name, name):
     return module.Command()
 
 
+@functools.lru_cache(maxsize=None)
 def get_commands():
+    """
+    Return a dictionary mapping command names to their application name.
+
+    The list is computed once per process; command modules are not imported,
+    see load_command_class().
+    """
     commands = {name: 'cpm.core' for name in find_commands(__path__[0])}
     other_commands = os.path.join(os.getcwd(), 'extra_commands')
     if os.path.exists(os.path.join(other_commands, 'commands')):
@@ -38,6 +59,91 @@ def get_commands():
     return commands
 
 
+def get_commands_dir(app_name):
+    if app_name == 'cpm.core':
+        return os.path.join(__path__[0], 'commands')
+    return os.path.join(os.getcwd(), app_name, 'commands')
+
+
+def get_command_manifest(commands_dir):
+    """
+    Return the path of the manifest of a commands directory, in the cache
+    directory of the user: the installation itself is never written to.
+    """
+    return os.path.join(default_cache_dir(), 'commands', '%s-%08x.json' % (
+        os.path.basename(os.path.dirname(commands_dir)), zlib.crc32(commands_dir.encode())))
+
+
+def _module_state(path):
+    # imported here for startup time: hashlib (and OpenSSL) is only needed
+    # when a command module changed since the help manifest was written
+    import hashlib
+    with open(path, 'rb') as f:
+        content = f.read()
+    st = os.stat(path)
+    return {'mtime': st.st_mtime_ns, 'size': st.st_size, 'hash': hashlib.sha1(content).hexdigest()}
+
+
+def _is_current(path, entry):
+    """Return True if the manifest ``entry`` still describes the module at ``path``."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if entry.get('mtime') == st.st_mtime_ns and entry.get('size') == st.st_size:
+        return True
+    # touched (e.g. by a checkout) but maybe not modified
+    if entry.get('hash') != _module_state(path)['hash']:
+        return False
+    entry['mtime'] = st.st_mtime_ns
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def get_command_descriptions():
+    """
+    Return a dictionary mapping command names to their description, without
+    importing the commands.
+
+    Descriptions are kept in a manifest per commands directory, in the user
+    cache directory (see get_command_manifest()). Only the modules added or
+    changed since the manifest was written are imported, and the manifest is
+    then written again.
+    """
+    by_dir = defaultdict(dict)
+    for name, app_name in get_commands().items():
+        by_dir[get_commands_dir(app_name)][name] = app_name
+    descriptions = {}
+    for commands_dir, commands in by_dir.items():
+        manifest_path = get_command_manifest(commands_dir)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        original = json.dumps(manifest, sort_keys=True)
+        for name in set(manifest) - set(commands):
+            del manifest[name]
+        for name, app_name in commands.items():
+            path = os.path.join(commands_dir, name + '.py')
+            entry = manifest.get(name, {})
+            if not _is_current(path, entry):
+                entry = dict(_module_state(path) if os.path.exists(path) else {},
+                             description=str(load_command_class(app_name, name).description))
+                manifest[name] = entry
+            descriptions[name] = entry['description']
+        if json.dumps(manifest, sort_keys=True) != original:
+            try:
+                os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+                tmp_path = '%s.%s.tmp' % (manifest_path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump(manifest, f, indent=1, sort_keys=True)
+                os.replace(tmp_path, manifest_path)
+            except OSError:
+                pass  # no writable cache directory: descriptions are recomputed next time
+    return descriptions
+
+
 def call_command(command_name, *args, **options):
     """
     Call the given command, with the given options and args/kwargs.
@@ -175,9 +281,10 @@ class ManagementUtility:
             for name in get_commands().keys():
                 commands_dict['cpm'].append(name)
 
+            descriptions = get_command_descriptions()
             for name in sorted(commands_dict['cpm']):
                 usage.append(
-                    f"   {name:24}{self.fetch_command(name).description}")
+                    f"   {name:24}{descriptions[name]}")
 
         return '\n'.join(usage)
 
@@ -253,6 +360,13 @@ class ManagementUtility:
         elif self.argv[1:] in (['--help'], ['-h']):
             sys.stdout.write(self.main_help_text() + '\n')
         else:
+            if subcommand in ('run', 'build'):
+                # served by a cpm serve daemon when one is running; the client
+                # (and socket) is imported only here to keep the startup short
+                from cpm.core.client import forward
+                status = forward(self.argv)
+                if status is not None:
+                    sys.exit(status)
             self.fetch_command(subcommand).run_from_argv(self.argv)
 
 
@@ -0,0 +1,26 @@
+import os
+import json
+from json import JSONDecodeError
+import cpm
+from cpm.core.color import style_error
+from cpm.utils.exceptions import CommandError
+
+
+def cpm_env():
+    """Return the environment of a cpm subprocess, importing this very cpm package."""
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, [os.path.dirname(cpm.__path__[0]), os.environ.get("PYTHONPATH")])))
+
+
+def load_results(path, version):
+    """Load the JSON results of an earlier benchmark, written with results ``version``."""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        raise CommandError("baseline file does not exist: %s" % style_error(path))
+    except JSONDecodeError as e:
+        raise CommandError("baseline file is not valid json: %s" % style_error(e))
+    if data.get("version") != version:
+        raise CommandError("%s is not a results file of this cpm version" % style_error(path))
+    return data
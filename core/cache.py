@@ -0,0 +1,458 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+import time
+import uuid
+from json import JSONDecodeError
+from cpm.core.manifest import file_digest
+from cpm.utils.config import default_cache_dir
+from cpm.utils.exceptions import CommandError
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# ioctl request cloning a whole file on copy-on-write filesystems (btrfs, xfs, ...)
+FICLONE = 0x40049409
+RESTORE_METHODS = ("reflink", "hardlink", "copy")
+# files the compiler writes next to an object and that belong with it
+# (the debug info of -gsplit-dwarf)
+COMPANION_SUFFIXES = (".dwo",)
+
+DEFAULT_MAX_SIZE = 5 * 1024 ** 3
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def has_debug_info(flags):
+    """
+    Return True if ``flags`` make the compiler write debug info, which records
+    the path of the object's ``.dwo`` file.
+    """
+    levels = [flag for flag in flags if flag.startswith("-g") and flag != "-gsplit-dwarf"]
+    return bool(levels) and levels[-1] != "-g0"
+
+
+def parse_size(value):
+    """Parse a size such as ``1073741824``, ``"500M"`` or ``"5G"`` into bytes."""
+    if isinstance(value, int):
+        return value
+    text = str(value).strip().upper().rstrip("B").rstrip("I")
+    number, unit = text.rstrip("KMGT"), text[len(text.rstrip("KMGT")):]
+    try:
+        return int(float(number) * SIZE_UNITS[unit])
+    except (ValueError, KeyError):
+        raise CommandError("invalid size: %r" % value)
+
+
+def get_max_size(cpm_json=None):
+    """
+    Return the cache size cap: ``$CPM_CACHE_MAX_SIZE``, else the
+    ``cache_max_size`` field of cpm.json, else 5G.
+    """
+    if os.environ.get("CPM_CACHE_MAX_SIZE"):
+        return parse_size(os.environ["CPM_CACHE_MAX_SIZE"])
+    if cpm_json and cpm_json.get("cache_max_size") is not None:
+        return parse_size(cpm_json["cache_max_size"])
+    return DEFAULT_MAX_SIZE
+
+
+class CacheLock:
+    """
+    Exclusive lock on the cache directory, held across threads of this process
+    and across every cpm process sharing the cache.
+    """
+    _thread_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, "a+")
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._file.close()
+            self._thread_lock.release()
+
+
+def link_or_copy(source, destination):
+    """
+    Materialize ``source`` at ``destination`` as cheaply as possible: a
+    reflink, else a hardlink, else a plain copy. Return the method used.
+    """
+    if fcntl is not None and hasattr(fcntl, "ioctl"):
+        try:
+            with open(source, "rb") as src, open(destination, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return "reflink"
+        except OSError:
+            if os.path.exists(destination):
+                os.remove(destination)
+    try:
+        os.link(source, destination)
+        return "hardlink"
+    except OSError:
+        shutil.copyfile(source, destination)
+        return "copy"
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class ObjectCache:
+    """
+    Content-addressed object cache shared by every cpm project (ccache-style,
+    direct mode).
+
+    A source is looked up by the hash of its content, the compiler identity and
+    the flags. Objects with debug info name their ``.dwo`` file by its path
+    relative to the working directory, so they are also keyed by that path:
+    checkouts with the same layout still share them. That direct key points to
+    a small manifest listing the header
+    sets (paths relative to the source, with their content hashes) seen for it,
+    and each header set to the object compiled from it. Only user headers
+    reported by ``-MMD`` are tracked; system headers are covered by the
+    compiler identity.
+
+    Cached objects are read-only and are restored into the build tree by
+    reflink or hardlink when the filesystem allows it, falling back to a copy.
+    Companion files of an object (``COMPANION_SUFFIXES``) are cached and
+    restored along with it.
+    The compile step removes an object before writing it, so a hardlinked
+    original is never modified through the link.
+
+    The cache is capped at ``max_size`` bytes, manifests included. Object
+    sizes, last-use times and manifests live in a compact index file, updated
+    once per build under an exclusive lock, and the least recently used
+    objects are evicted when the cap is exceeded, along with their entries in
+    the manifests.
+    """
+    objects_dir = "objects"
+    manifests_dir = "manifests"
+    index_file = "index.json"
+    lock_file = "lock"
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._digests = {}
+        self._stats = {"hits": 0, "misses": 0, "bytes_saved": 0}
+        self._stats.update(dict.fromkeys(RESTORE_METHODS, 0))
+        # object key -> (size, manifest key), for objects used or stored during this build
+        self._used = {}
+
+    def lock(self):
+        return CacheLock(os.path.join(self.cache_dir, self.lock_file))
+
+    def _digest(self, path):
+        # headers are shared by many sources, hash each one once per build
+        with self._lock:
+            if path in self._digests:
+                return self._digests[path]
+        digest = file_digest(path) if os.path.exists(path) else None
+        with self._lock:
+            self._digests[path] = digest
+        return digest
+
+    def _path(self, kind, key, suffix):
+        return os.path.join(self.cache_dir, kind, key[:2], key + suffix)
+
+    def direct_key(self, source_file, compiler, flags, object_file=None):
+        parts = [compiler, json.dumps(flags), self._digest(source_file)]
+        if object_file is not None and has_debug_info(flags):
+            parts.append(os.path.relpath(object_file).replace(os.sep, "/"))
+        digest = hashlib.sha1()
+        for part in parts:
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _read_manifest(self, key):
+        try:
+            with open(self._path(self.manifests_dir, key, ".json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, JSONDecodeError):
+            return []
+
+    def lookup(self, source_file, compiler, flags, object_file=None):
+        """
+        Return ``(object_key, headers, manifest_key)`` of a cached compile of
+        ``source_file`` into ``object_file`` whose headers all still match,
+        else None.
+        """
+        source_dir = os.path.dirname(source_file)
+        key = self.direct_key(source_file, compiler, flags, object_file)
+        for candidate in self._read_manifest(key):
+            headers = [os.path.normpath(os.path.join(source_dir, header))
+                       for header in candidate["headers"]]
+            if all(self._digest(path) == digest
+                   for path, digest in zip(headers, candidate["headers"].values())):
+                object_path = self._path(self.objects_dir, candidate["object"], ".o")
+                if os.path.exists(object_path):
+                    return candidate["object"], headers, key
+        return None
+
+    def fetch(self, source_file, object_file, compiler, flags):
+        """
+        Restore ``object_file`` from the cache. Return the headers of the
+        cached compile on a hit, None on a miss.
+        """
+        found = self.lookup(source_file, compiler, flags, object_file)
+        if found is not None:
+            object_key, headers, key = found
+            try:
+                method = self.restore(self._path(self.objects_dir, object_key, ".o"), object_file)
+                for suffix in COMPANION_SUFFIXES:
+                    companion = os.path.splitext(object_file)[0] + suffix
+                    if os.path.exists(self._path(self.objects_dir, object_key, suffix)):
+                        self.restore(self._path(self.objects_dir, object_key, suffix), companion)
+                    elif os.path.lexists(companion):
+                        os.remove(companion)
+            except FileNotFoundError:
+                # evicted by another cpm process since the lookup
+                found = None
+        with self._lock:
+            if found is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            self._stats[method] += 1
+            self._stats["bytes_saved"] += os.path.getsize(object_file)
+            self._used[object_key] = (sum(
+                os.path.getsize(path) for path in [object_file, *(
+                    os.path.splitext(object_file)[0] + suffix for suffix in COMPANION_SUFFIXES)]
+                if os.path.exists(path)), key)
+        return headers
+
+    def restore(self, object_path, object_file):
+        """Place a cached object at ``object_file``; return the method used."""
+        if os.path.lexists(object_file):
+            os.remove(object_file)
+        return link_or_copy(object_path, object_file)
+
+    def build_stats(self):
+        """Return the statistics of this build only."""
+        return dict(self._stats)
+
+    def store(self, source_file, object_file, compiler, flags, headers):
+        """Add a freshly compiled ``object_file`` to the cache."""
+        source_dir = os.path.dirname(source_file)
+        header_digests = {}
+        for header in sorted(headers):
+            if os.path.abspath(header) == source_file:
+                continue
+            digest = self._digest(header)
+            if digest is None:
+                return
+            header_digests[os.path.relpath(header, source_dir)] = digest
+        key = self.direct_key(source_file, compiler, flags, object_file)
+        object_key = hashlib.sha1(
+            (key + json.dumps(header_digests, sort_keys=True)).encode()).hexdigest()
+        object_path = self._path(self.objects_dir, object_key, ".o")
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        size = 0
+        # companions first: an object is only found once they are in place
+        for suffix in COMPANION_SUFFIXES:
+            companion = os.path.splitext(object_file)[0] + suffix
+            if os.path.exists(companion):
+                size += self._store_file(companion, self._path(self.objects_dir, object_key, suffix))
+        size += self._store_file(object_file, object_path)
+        with self.lock():
+            candidates = [candidate for candidate in self._read_manifest(key)
+                          if candidate["object"] != object_key]
+            candidates.append({"headers": header_digests, "object": object_key})
+            _write_atomic(self._path(self.manifests_dir, key, ".json"),
+                          json.dumps(candidates).encode())
+        with self._lock:
+            self._used[object_key] = (size, key)
+
+    def _store_file(self, path, cached_path):
+        """Place a copy of ``path`` at ``cached_path``; return its size."""
+        tmp_path = "%s.%s.tmp" % (cached_path, uuid.uuid4().hex)
+        link_or_copy(path, tmp_path)
+        # cached objects are never written again, protect them from the links
+        os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, cached_path)
+        return os.path.getsize(cached_path)
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, self.index_file)) as f:
+                index = json.load(f)
+        except (FileNotFoundError, JSONDecodeError):
+            index = {}
+        index.setdefault("stats", {})
+        # object key -> [size, last use, manifest key]
+        index.setdefault("objects", {})
+        # manifest key -> size
+        index.setdefault("manifests", {})
+        return index
+
+    def _write_index(self, index):
+        _write_atomic(os.path.join(self.cache_dir, self.index_file),
+                      json.dumps(index, separators=(",", ":")).encode())
+
+    def stats(self):
+        """Return the persisted statistics merged with this process' ones."""
+        index = self._read_index()
+        stats = {name: index["stats"].get(name, 0) + value for name, value in self._stats.items()}
+        stats["objects"] = len(index["objects"])
+        stats["size"] = self._total_size(index)
+        stats["max_size"] = self.max_size
+        return stats
+
+    def flush(self):
+        """
+        Merge this build's statistics and object usage into the index, then
+        evict least recently used objects if the cache grew past its cap.
+        """
+        if not any(self._stats.values()) and not self._used:
+            return
+        with self.lock():
+            index = self._read_index()
+            for name, value in self._stats.items():
+                index["stats"][name] = index["stats"].get(name, 0) + value
+            now = int(time.time())
+            for object_key, (size, key) in self._used.items():
+                index["objects"][object_key] = [size, now, key]
+                path = self._path(self.manifests_dir, key, ".json")
+                if os.path.exists(path):
+                    index["manifests"][key] = os.path.getsize(path)
+            self._evict(index)
+            self._write_index(index)
+        self._stats = dict.fromkeys(self._stats, 0)
+        self._used = {}
+
+    def _total_size(self, index):
+        return (sum(entry[0] for entry in index["objects"].values()) +
+                sum(index["manifests"].values()))
+
+    def _evict(self, index):
+        """
+        Remove least recently used objects until the cache fits ``max_size``,
+        and their candidates from the manifests; a manifest left without
+        candidates is removed.
+        """
+        objects = index["objects"]
+        evicted = 0
+        # summed once and kept up to date: re-summing per object is quadratic
+        total_size = self._total_size(index)
+        for object_key in sorted(objects, key=lambda key: objects[key][1]):
+            if total_size <= self.max_size:
+                break
+            entry = objects.pop(object_key)
+            total_size -= entry[0]
+            for suffix in (".o", *COMPANION_SUFFIXES):
+                try:
+                    os.remove(self._path(self.objects_dir, object_key, suffix))
+                except FileNotFoundError:
+                    pass
+            if len(entry) > 2:
+                total_size -= self._trim_manifest(index, entry[2], {object_key})
+            evicted += 1
+        if not objects:
+            # nothing left for a manifest to point to
+            for key in list(index["manifests"]):
+                self._trim_manifest(index, key, None)
+        return evicted
+
+    def _trim_manifest(self, index, key, object_keys):
+        """
+        Drop the candidates of manifest ``key`` pointing to ``object_keys``
+        (all of them when None), and the manifest once it has none left.
+        Return the number of bytes the manifest shrank by.
+        """
+        path = self._path(self.manifests_dir, key, ".json")
+        size = index["manifests"].get(key, 0)
+        candidates = [] if object_keys is None else [
+            candidate for candidate in self._read_manifest(key) if candidate["object"] not in object_keys]
+        if candidates:
+            _write_atomic(path, json.dumps(candidates).encode())
+            index["manifests"][key] = os.path.getsize(path)
+            return size - index["manifests"][key]
+        index["manifests"].pop(key, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return size
+
+    def prune(self):
+        """
+        Trim the cache to ``max_size`` in one pass. Objects missing from the
+        index are adopted with their mtime as last use, and index entries
+        whose object is gone are dropped, as are the manifest candidates
+        pointing to them. Return (evicted objects, size).
+        """
+        with self.lock():
+            index = self._read_index()
+            objects = {}
+            objects_root = os.path.join(self.cache_dir, self.objects_dir)
+            if os.path.isdir(objects_root):
+                for bucket in os.scandir(objects_root):
+                    if not bucket.is_dir():
+                        continue
+                    for entry in os.scandir(bucket.path):
+                        if not entry.name.endswith(".o"):
+                            # leftovers of interrupted writes, not ones still in progress
+                            if (entry.name.endswith(".tmp") and
+                                    entry.stat().st_mtime < time.time() - 3600):
+                                os.remove(entry.path)
+                            continue
+                        object_key = entry.name[:-len(".o")]
+                        st = entry.stat()
+                        last_used = index["objects"].get(object_key, [0, int(st.st_mtime)])[1]
+                        size = st.st_size
+                        for suffix in COMPANION_SUFFIXES:
+                            companion = entry.path[:-len(".o")] + suffix
+                            if os.path.exists(companion):
+                                size += os.path.getsize(companion)
+                        objects[object_key] = [size, last_used]
+            index["objects"] = objects
+            index["manifests"] = {}
+            manifests_root = os.path.join(self.cache_dir, self.manifests_dir)
+            if os.path.isdir(manifests_root):
+                for bucket in os.scandir(manifests_root):
+                    if not bucket.is_dir():
+                        continue
+                    for entry in os.scandir(bucket.path):
+                        if not entry.name.endswith(".json"):
+                            continue
+                        key = entry.name[:-len(".json")]
+                        index["manifests"][key] = entry.stat().st_size
+                        candidates = self._read_manifest(key)
+                        missing = set()
+                        for candidate in candidates:
+                            if candidate["object"] in objects:
+                                objects[candidate["object"]][2:] = [key]
+                            else:
+                                missing.add(candidate["object"])
+                        if missing or not candidates:
+                            self._trim_manifest(index, key, missing)
+            evicted = self._evict(index)
+            self._write_index(index)
+        return evicted, self._total_size(index)
@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import stat
+import zlib
+import socket
+import struct
+
+# commands a cpm serve daemon can build
+DAEMON_COMMANDS = ("run", "build")
+
+
+def is_private(st):
+    """Return True if ``st`` (an os.stat result) belongs to this user and only to them."""
+    return st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def runtime_dir_path():
+    """
+    Return the directory of the daemon sockets of this user:
+    ``$XDG_RUNTIME_DIR/cpm``, else ``cpm-<uid>`` in ``$TMPDIR`` or /tmp.
+    """
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    if base:
+        return os.path.join(base, "cpm")
+    return os.path.join(os.environ.get("TMPDIR") or "/tmp", "cpm-%s" % os.getuid())
+
+
+def runtime_dir():
+    """
+    Return the directory of the daemon sockets, created with mode 0700.
+    Return None when it is not a directory owned by this user and closed to
+    everyone else: another user could then place a socket in it.
+    """
+    path = runtime_dir_path()
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    except OSError:
+        return None
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or not is_private(st):
+        return None
+    return path
+
+
+def socket_path(project_dir):
+    """
+    Return the path of the Unix socket of the cpm serve daemon of a project,
+    or None when there is no private directory to put it in.
+    """
+    directory = runtime_dir()
+    if directory is None:
+        return None
+    project_dir = os.path.realpath(project_dir)
+    return os.path.join(directory, "%08x.sock" % zlib.crc32(project_dir.encode()))
+
+
+def connect(project_dir):
+    """
+    Return a socket connected to the daemon of ``project_dir``, or None. Only
+    a socket of this user, closed to others, served by a process of this
+    user, is trusted.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    path = socket_path(project_dir)
+    if path is None:
+        return None
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if not stat.S_ISSOCK(st.st_mode) or not is_private(st):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        if hasattr(socket, "SO_PEERCRED"):
+            _, uid, _ = struct.unpack("3i", sock.getsockopt(
+                socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+            if uid != os.getuid():
+                raise ConnectionRefusedError("daemon of another user")
+    except OSError:
+        # stale socket of a daemon that did not exit cleanly
+        sock.close()
+        return None
+    return sock
+
+
+def project_executable(project_dir, exe_name):
+    """
+    Return the real path of ``exe_name`` when it is an executable file in a
+    ``build/<profile>/`` directory of the project, else None.
+    """
+    build_dir = os.path.join(os.path.realpath(project_dir), "build")
+    executable = os.path.realpath(os.path.join(project_dir, exe_name))
+    relative = os.path.relpath(executable, build_dir).split(os.sep)
+    if len(relative) < 2 or os.pardir in relative:
+        return None
+    if not os.path.isfile(executable) or not os.access(executable, os.X_OK):
+        return None
+    return executable
+
+
+def request(sock, message, stdout=None, stderr=None):
+    """
+    Send ``message`` to the daemon and relay its output to ``stdout`` and
+    ``stderr`` until it answers; return the answer, or None if the daemon
+    went away.
+    """
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    with sock, sock.makefile("rw", encoding="utf-8", newline="\n") as f:
+        f.write(json.dumps(message) + "\n")
+        f.flush()
+        for line in f:
+            reply = json.loads(line)
+            if "stdout" in reply:
+                stdout.write(reply["stdout"])
+                stdout.flush()
+            elif "stderr" in reply:
+                stderr.write(reply["stderr"])
+                stderr.flush()
+            else:
+                return reply
+    return None
+
+
+def forward(argv):
+    """
+    Hand a ``run`` or ``build`` command line to the cpm serve daemon of the
+    current project. Return None when no daemon can take it, the command then
+    runs in process; otherwise return its exit status. The daemon only
+    builds: the program of ``run`` is started from here, in place of this
+    process.
+    """
+    if len(argv) < 2 or argv[1] not in DAEMON_COMMANDS:
+        return None
+    if any(arg in ("--no-daemon", "-h", "--help", "-v", "--version") for arg in argv[2:]):
+        return None
+    sock = connect(os.getcwd())
+    if sock is None:
+        return None
+    try:
+        reply = request(sock, {"argv": argv[1:], "cwd": os.getcwd()})
+    except (OSError, ValueError):
+        return None
+    if reply is None or reply.get("fallback"):
+        return None
+    if reply["status"] == 0 and argv[1] == "run":
+        executable = project_executable(os.getcwd(), str(reply.get("exe", "")))
+        if executable is None:
+            # not a program of this project: build and run in process
+            return None
+        sys.stdout.flush()
+        os.execv(executable, [executable])
+    return reply["status"]
@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+from cpm.core import stats
+from cpm.core.benchmark import cpm_env
+from cpm.core.color import colorize, style_error, style_success, style_warning, style_cpm
+from cpm.core.commands import run
+from cpm.core.commands.cache import format_size
+from cpm.core.executor import format_command
+from cpm.utils.base import ExecutionTime
+from cpm.utils.exceptions import CommandError
+
+
+class Command(run.Command):
+    help = "Benchmark the built {program}".format(
+        program=colorize("program", fg="blue", opts=("bold",)))
+    description = "Benchmarks the c++ program."
+    results_version = 1
+    # measured resources: times in seconds, max_rss in bytes
+    metrics = ("wall", "user", "system", "max_rss")
+
+    def add_arguments(self, parser):
+        parser.add_argument('args', nargs='*',
+                            help='Arguments of the program; put them after -- when one starts '
+                                 'with a dash.')
+        parser.add_argument('--profile', '-p', dest='profile', default='release',
+                            help='Build profile of the benchmarked program (default: release).')
+        parser.add_argument('--runs', '-n', dest='runs', type=int, default=10,
+                            help='Number of measured runs (default: 10).')
+        parser.add_argument('--warmup', dest='warmup', type=int, default=2,
+                            help='Number of runs before measuring, not recorded (default: 2).')
+        parser.add_argument('--input', '-i', dest='input', metavar='FILE',
+                            help='File fed to the program on stdin.')
+        parser.add_argument('--confidence', dest='confidence', type=float, default=0.95,
+                            help='Confidence level of the intervals and of the comparison '
+                                 '(default: 0.95).')
+        parser.add_argument('--compare', dest='compare', metavar='PROFILE_OR_REVISION',
+                            help='Baseline to compare with: build a profile, or a git revision of '
+                                 'the project with the same profile, and run it interleaved with '
+                                 'the benchmarked program.')
+        parser.add_argument('--output', '-o', dest='output', default='bench.json',
+                            help='JSON file the results are written to (default: bench.json).')
+        parser.add_argument('--jobs', '-j', dest='jobs', type=int, default=os.cpu_count() or 1,
+                            help='Number of translation units to compile in parallel '
+                                 '(default: number of CPUs).')
+
+    def handle(self, *args, **options):
+        if options["runs"] < 2:
+            raise CommandError("--runs must be at least 2")
+        if options["warmup"] < 0:
+            raise CommandError("--warmup must not be negative")
+        if not 0 < options["confidence"] < 1:
+            raise CommandError("--confidence must be between 0 and 1")
+        if options["jobs"] < 1:
+            raise CommandError("--jobs must be a positive number, got %s" %
+                               style_error(str(options["jobs"])))
+        if options["input"] is not None and not os.path.isfile(options["input"]):
+            raise CommandError("input does not exist: %s" % style_error(options["input"]))
+        if not hasattr(os, "wait4"):
+            raise CommandError("cpm bench reads the resource usage of os.wait4, "
+                               "which this platform does not have")
+        current_dir, cpp_file_name, cpm_json = self.load_project()
+        profile = self.get_profile(cpm_json, options["profile"])[0]
+        variants = [(profile, self.build(current_dir, cpp_file_name, cpm_json, options["jobs"],
+                                         self.get_cache(cpm_json), profile=profile))]
+        worktree = None
+        try:
+            compare = options["compare"]
+            if compare is not None and compare in dict(self.profiles, **cpm_json.get("profiles", {})):
+                if compare == profile:
+                    raise CommandError("cannot compare profile %s with itself" % style_error(compare))
+                variants.insert(0, (compare, self.build(current_dir, cpp_file_name, cpm_json,
+                                                        options["jobs"], self.get_cache(cpm_json),
+                                                        profile=compare)))
+            elif compare is not None:
+                worktree, exe_name = self.build_revision(current_dir, compare, profile, options["jobs"])
+                variants.insert(0, (compare, exe_name))
+            measurements = self.run_benchmark(current_dir, variants, list(args), options["input"],
+                                              options["warmup"], options["runs"])
+        finally:
+            if worktree is not None:
+                self.remove_worktree(current_dir, worktree)
+        metrics = list(self.metrics)
+        if any(measurement.max_rss is None for runs in measurements.values() for measurement in runs):
+            self.stdout.write("[ %s ] --- peak memory not measured: no C compiler to build the "
+                              "measuring program" % style_warning("max_rss"))
+            metrics.remove("max_rss")
+        results = {}
+        for label, exe_name in variants:
+            # the executable of a revision is gone with its worktree
+            executable = label if worktree and exe_name.startswith(worktree) else os.path.relpath(exe_name)
+            results[label] = {
+                "executable": executable,
+                "runs": [{metric: getattr(measurement, metric if metric != "wall" else "seconds")
+                          for metric in metrics} for measurement in measurements[label]],
+            }
+            for metric in metrics:
+                results[label][metric] = stats.summarize(
+                    [sample[metric] for sample in results[label]["runs"]], options["confidence"])
+            self.report(label, executable, results[label], options["confidence"], metrics)
+        data = {
+            "version": self.results_version,
+            "args": list(args),
+            "input": options["input"],
+            "warmup": options["warmup"],
+            "confidence": options["confidence"],
+            "results": results,
+        }
+        if len(variants) == 2:
+            (baseline, _), (candidate, _) = variants
+            data["comparison"] = {metric: stats.compare(
+                [sample[metric] for sample in results[baseline]["runs"]],
+                [sample[metric] for sample in results[candidate]["runs"]], options["confidence"])
+                for metric in metrics}
+            self.report_comparison(baseline, candidate, data["comparison"], options["confidence"])
+        with open(options["output"], "w") as f:
+            json.dump(data, f, indent=2)
+        self.stdout.write("[ %s ] --- %s" % (style_success("results"), style_warning(options["output"])))
+
+    def build_revision(self, current_dir, revision, profile, jobs):
+        """
+        Check ``revision`` out into a temporary git worktree and build it there
+        with ``profile``, in a cpm subprocess. Return the worktree and the
+        absolute path of the executable.
+        """
+        if shutil.which("git") is None:
+            raise CommandError("%s is neither a profile nor a git revision: git is not installed" %
+                               style_error(revision))
+        prefix = self.executor.run(["git", "rev-parse", "--show-prefix"], cwd=current_dir)
+        if prefix.returncode != 0:
+            raise CommandError("%s is neither a profile nor a git revision: %s" % (
+                style_error(revision), prefix.output))
+        worktree = tempfile.mkdtemp(prefix="cpm-bench-")
+        result = self.executor.run(["git", "worktree", "add", "--detach", worktree, revision],
+                                   cwd=current_dir)
+        if result.returncode != 0:
+            shutil.rmtree(worktree, ignore_errors=True)
+            raise CommandError("%s is neither a profile nor a git revision:\n%s" % (
+                style_error(revision), result.output))
+        try:
+            project_dir = os.path.join(worktree, prefix.stdout.strip())
+            argv = [sys.executable, "-m", "cpm", "build", "--no-daemon", "--profile", profile,
+                    "--jobs", str(jobs)]
+            env = cpm_env()
+            self.stdout.write("[ %s ] --- %s" % (style_success("build"), style_warning(revision)))
+            result = self.executor.run(argv, cwd=project_dir, env=env)
+            if result.returncode != 0:
+                raise CommandError("build of %s failed:\n%s\n%s" % (
+                    style_error(revision), style_error(format_command(argv)), result.output))
+            cpp_file_name = self.load_cpm_config(project_dir).get("entry_point", "")
+            return worktree, os.path.join(project_dir, self.get_executable(cpp_file_name, profile))
+        except BaseException:
+            self.remove_worktree(current_dir, worktree)
+            raise
+
+    def remove_worktree(self, current_dir, worktree):
+        result = self.executor.run(["git", "worktree", "remove", "--force", worktree], cwd=current_dir)
+        if result.returncode != 0:
+            shutil.rmtree(worktree, ignore_errors=True)
+            self.executor.run(["git", "worktree", "prune"], cwd=current_dir)
+
+    def run_benchmark(self, current_dir, variants, arguments, input_file, warmup, runs):
+        """
+        Run every variant ``warmup`` times, then ``runs`` measured times.
+        Variants are interleaved: each round runs all of them, in reverse
+        order every other round, so a drift of the machine (frequency
+        scaling, another load) weighs on all of them alike. Return the
+        measurements of each variant.
+        """
+        measurements = {label: [] for label, _ in variants}
+        for number in range(warmup + runs):
+            for label, exe_name in (variants if number % 2 == 0 else variants[::-1]):
+                measurement = self.run_once(current_dir, exe_name, arguments, input_file)
+                if number >= warmup:
+                    measurements[label].append(measurement)
+        return measurements
+
+    def run_once(self, current_dir, exe_name, arguments, input_file):
+        argv = [os.path.abspath(exe_name), *arguments]
+        with open(input_file or os.devnull, "rb") as stdin:
+            measurement = self.executor.measure(argv, cwd=current_dir, stdin=stdin)
+        if measurement.returncode != 0:
+            raise CommandError("%s exited with %s:\n%s" % (
+                style_error(format_command(argv)), measurement.returncode, measurement.stderr))
+        return measurement
+
+    def format_value(self, metric, value):
+        if metric == "max_rss":
+            return format_size(value)
+        return ExecutionTime().timeformat(value)
+
+    def report(self, label, executable, result, confidence, metrics):
+        self.stdout.write("[ %s ] --- %s --- %s runs" % (
+            style_success(label), style_cpm(executable), len(result["runs"])))
+        for metric in metrics:
+            summary = result[metric]
+            half_width = (summary["ci"][1] - summary["ci"][0]) / 2
+            self.stdout.write("    %-8s mean %s ± %s (%d%% CI), median %s, stdev %s, min %s" % (
+                metric, self.format_value(metric, summary["mean"]),
+                self.format_value(metric, half_width), round(confidence * 100),
+                self.format_value(metric, summary["median"]), self.format_value(metric, summary["stdev"]),
+                self.format_value(metric, summary["min"])))
+
+    def report_comparison(self, baseline, candidate, comparison, confidence):
+        for metric in comparison:
+            result = comparison[metric]
+            if result["significant"]:
+                style = style_error if result["difference"] > 0 else style_success
+                verdict = style("%+.1f%%" % (result["change"] * 100))
+            else:
+                verdict = "no significant difference (%+.1f%%)" % (result["change"] * 100)
+            self.stdout.write("[ %s ] --- %s -> %s %-8s %s at %d%% confidence" % (
+                style_warning("compare"), baseline, candidate, metric, verdict, round(confidence * 100)))
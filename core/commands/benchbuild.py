@@ -0,0 +1,219 @@
+import os
+import io
+import sys
+import json
+import shutil
+import platform
+import tempfile
+import statistics
+from cpm.core.base import BaseCommand, CommandError
+from cpm.core.benchmark import cpm_env, load_results
+from cpm.core.color import colorize, style_error, style_success, style_warning
+from cpm.core.executor import Executor, format_command
+from cpm.core.template import TemplateCommand
+from cpm.utils.base import ExecutionTime
+
+
+class SyntheticProject(TemplateCommand):
+    """
+    Scaffold a project with the project and app templates, then fill every
+    app with generated headers and sources.
+
+    Each app has ``headers`` headers and ``sources`` sources; every source
+    includes ``fan_out`` headers of its app (the first header is included by
+    all of them) and instantiates the templates they declare, so the compile
+    time grows with the fan-out like in real projects.
+    """
+
+    def __init__(self, apps=4, sources=8, headers=4, fan_out=2):
+        super().__init__(stdout=io.StringIO(), stderr=io.StringIO())
+        self.apps = ["app%s" % number for number in range(apps)]
+        self.sources = sources
+        self.headers = headers
+        self.fan_out = min(fan_out, headers)
+
+    def handle_level(self, name, target, **options):
+        if self.app_or_project == "project":
+            return {"name": name, "version": "1.0.0", "entry_point": "main.cpp",
+                    "apps": [{"name": app_name} for app_name in self.apps]}
+
+    def generate(self, directory):
+        """Generate the project into the empty ``directory``; return its path."""
+        os.makedirs(directory, exist_ok=True)
+        self.handle("project", "bench", directory)
+        for app_name in self.apps:
+            self.handle("app", app_name, directory)
+            for number in range(self.headers):
+                self.write(os.path.join(directory, app_name, "include", "%s.hpp" % self.header_name(
+                    app_name, number)), self.header_content(app_name, number))
+            for number in range(self.sources):
+                self.write(os.path.join(directory, app_name, "source", "%s_%s.cpp" % (
+                    app_name, number)), self.source_content(app_name, number))
+        return directory
+
+    def header_name(self, app_name, number):
+        return "%s_h%s" % (app_name, number)
+
+    def included_headers(self, app_name, number):
+        """Return the header numbers included by source ``number`` of an app."""
+        return sorted({0} | {(number + step) % self.headers for step in range(1, self.fan_out)})
+
+    def header_content(self, app_name, number):
+        name = self.header_name(app_name, number)
+        return (
+            "#pragma once\n"
+            "#include <map>\n#include <string>\n#include <vector>\n#include <algorithm>\n\n"
+            "template <typename T>\n"
+            "struct %(name)s {\n"
+            "    std::vector<T> values;\n"
+            "    std::map<std::string, T> named;\n"
+            "    T sum() const { T total{}; for (const T &value : values) total += value; return total; }\n"
+            "    void sort() { std::sort(values.begin(), values.end()); }\n"
+            "};\n" % {"name": name}
+        )
+
+    def source_content(self, app_name, number):
+        headers = self.included_headers(app_name, number)
+        includes = "".join('#include "../include/%s.hpp"\n' % self.header_name(app_name, header)
+                           for header in headers)
+        body = "".join(
+            "    %(name)s<int> a%(n)s; a%(n)s.values = {3, 1, 2}; a%(n)s.sort(); total += a%(n)s.sum();\n"
+            "    %(name)s<double> b%(n)s; b%(n)s.named[\"x\"] = 1.5; total += int(b%(n)s.named.size());\n"
+            % {"name": self.header_name(app_name, header), "n": header} for header in headers)
+        return "%s\nint %s_%s()\n{\n    int total = 0;\n%s    return total;\n}\n" % (
+            includes, app_name, number, body)
+
+    def write(self, path, content):
+        with open(path, "w") as f:
+            f.write(content)
+
+
+class Command(BaseCommand):
+    help = "Benchmark the {build} of a synthetic project".format(
+        build=colorize("build", fg="blue", opts=("bold",)))
+    description = "Benchmarks cpm builds."
+    scenarios = ("cold", "no-op", "source edit", "header edit")
+    results_version = 1
+
+    def add_arguments(self, parser):
+        parser.add_argument('--apps', type=int, default=4, help='Number of apps (default: 4).')
+        parser.add_argument('--sources', type=int, default=8,
+                            help='Number of sources per app (default: 8).')
+        parser.add_argument('--headers', type=int, default=4,
+                            help='Number of headers per app (default: 4).')
+        parser.add_argument('--fan-out', dest='fan_out', type=int, default=2,
+                            help='Number of headers each source includes (default: 2).')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Number of runs of each scenario (default: 3).')
+        parser.add_argument('--jobs', '-j', dest='jobs', type=int, default=os.cpu_count() or 1,
+                            help='Jobs of the benchmarked builds (default: number of CPUs).')
+        parser.add_argument('--backend', dest='backend', choices=("cpm", "ninja"), default="cpm",
+                            help='Backend of the benchmarked builds (default: cpm).')
+        parser.add_argument('--output', '-o', dest='output', default='bench-build.json',
+                            help='JSON file the results are written to (default: bench-build.json).')
+        parser.add_argument('--baseline', dest='baseline',
+                            help='JSON results of an earlier run to compare with.')
+        parser.add_argument('--directory', '-d', dest='directory',
+                            help='Generate the project in this directory and keep it.')
+
+    def handle(self, **options):
+        for option in ("apps", "sources", "headers", "fan_out", "repeat", "jobs"):
+            if options[option] < 1:
+                raise CommandError("--%s must be a positive number" % option.replace("_", "-"))
+        baseline = load_results(options["baseline"], self.results_version) if options["baseline"] else None
+        project = SyntheticProject(options["apps"], options["sources"], options["headers"],
+                                   options["fan_out"])
+        keep = options["directory"] is not None
+        if keep and os.path.exists(os.path.join(options["directory"], "cpm.json")):
+            raise CommandError("%s already contains a project" % style_error(options["directory"]))
+        directory = os.path.abspath(options["directory"] or tempfile.mkdtemp(prefix="cpm-bench-"))
+        try:
+            project.generate(directory)
+            self.stdout.write("[ %s ] --- %s apps x %s sources x %s headers, fan-out %s --- %s" % (
+                style_success("project"), options["apps"], options["sources"], options["headers"],
+                project.fan_out, style_warning(directory)))
+            results = self.run_scenarios(project, directory, options)
+        finally:
+            if not keep:
+                shutil.rmtree(directory, ignore_errors=True)
+        data = {
+            "version": self.results_version,
+            "parameters": {option: options[option] for option in (
+                "apps", "sources", "headers", "fan_out", "repeat", "jobs", "backend")},
+            "machine": self.machine(),
+            "results": results,
+        }
+        if baseline is not None and any(baseline["parameters"].get(option) != value for option, value
+                                        in data["parameters"].items() if option != "repeat"):
+            self.stdout.write("[ %s ] --- the baseline was measured with other parameters: %s" % (
+                style_warning("baseline"), baseline["parameters"]))
+        self.report(results, baseline)
+        with open(options["output"], "w") as f:
+            json.dump(data, f, indent=2)
+        self.stdout.write("[ %s ] --- %s" % (style_success("results"), style_warning(options["output"])))
+
+    def run_scenarios(self, project, directory, options):
+        command = [sys.executable, "-m", "cpm", "build", "--jobs", str(options["jobs"]),
+                   "--backend", options["backend"], "--no-cache"]
+        env = cpm_env()
+        executor = Executor()
+        first_app = project.apps[0]
+        source = os.path.join(directory, first_app, "source", "%s_0.cpp" % first_app)
+        # the first header of an app is included by all of its sources
+        header = os.path.join(directory, first_app, "include", "%s.hpp" % project.header_name(first_app, 0))
+        runs = {scenario: [] for scenario in self.scenarios}
+        for repeat in range(options["repeat"]):
+            for scenario in self.scenarios:
+                if scenario == "cold":
+                    self.clean(directory)
+                elif scenario == "source edit":
+                    self.append(source, "// edit %s\n" % repeat)
+                elif scenario == "header edit":
+                    self.append(header, "// edit %s\n" % repeat)
+                result = executor.run(command, cwd=directory, env=env)
+                if result.returncode != 0:
+                    raise CommandError("%s build failed:\n%s\n%s" % (
+                        scenario, style_error(format_command(command)), result.output))
+                runs[scenario].append(result.seconds)
+                self.stdout.write("[ %s ] --- run %s" % (style_warning(scenario), repeat + 1),
+                                  ending=" %s\n" % ExecutionTime().timeformat(result.seconds))
+        return {scenario: {"runs": seconds, "min": min(seconds), "median": statistics.median(seconds)}
+                for scenario, seconds in runs.items()}
+
+    def clean(self, directory):
+        """
+        Remove everything a build wrote: the objects, build.ninja, the ninja
+        logs and the executable all live in build/<profile>/.
+        """
+        build_dir = os.path.join(directory, "build")
+        shutil.rmtree(build_dir, ignore_errors=True)
+        if os.path.exists(build_dir):
+            raise CommandError("cannot remove %s before a cold build" % style_error(build_dir))
+
+    def append(self, path, content):
+        with open(path, "a") as f:
+            f.write(content)
+
+    def machine(self):
+        compiler = Executor().run(["g++", "--version"])
+        return {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "compiler": compiler.stdout.partition("\n")[0] if compiler.returncode == 0 else None,
+        }
+
+    def report(self, results, baseline=None):
+        """Print the median of each scenario, compared with the ``baseline`` when given."""
+        execution_time = ExecutionTime()
+        for scenario, result in results.items():
+            line = "[ %s ] --- median %s min %s" % (
+                style_success(scenario), execution_time.timeformat(result["median"]),
+                execution_time.timeformat(result["min"]))
+            previous = (baseline or {}).get("results", {}).get(scenario)
+            if previous:
+                change = (result["median"] - previous["median"]) / previous["median"] * 100
+                style = style_error if change > 0 else style_success
+                line += " --- baseline %s (%s)" % (execution_time.timeformat(previous["median"]),
+                                                  style("%+.1f%%" % change))
+            self.stdout.write(line)
@@ -0,0 +1,98 @@
+import sys
+import json
+import statistics
+from cpm.core.base import BaseCommand, CommandError
+from cpm.core.benchmark import cpm_env, load_results
+from cpm.core.color import colorize, style_error, style_success, style_warning
+from cpm.core.executor import Executor, format_command
+from cpm.utils.base import ExecutionTime
+
+
+def parse_importtime(output):
+    """
+    Parse the ``-X importtime`` report of a process; return a list of
+    ``(module, self_us, cumulative_us, depth)``.
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return imports
+
+
+class Command(BaseCommand):
+    help = "Benchmark the {startup} time of cpm".format(
+        startup=colorize("startup", fg="blue", opts=("bold",)))
+    description = "Benchmarks cpm startup."
+    commands = (("help",), ("version",))
+    results_version = 1
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=10,
+                            help='Number of runs of each command (default: 10).')
+        parser.add_argument('--output', '-o', dest='output', default='bench-startup.json',
+                            help='JSON file the results are written to (default: bench-startup.json).')
+        parser.add_argument('--baseline', dest='baseline',
+                            help='JSON results of an earlier run to compare with.')
+        parser.add_argument('--max-regression', dest='max_regression', type=float, default=20.0,
+                            help='Fail when a median startup is this many percent slower than '
+                                 'the baseline (default: 20).')
+        parser.add_argument('--top', type=int, default=5,
+                            help='Number of slowest imports to show (default: 5).')
+
+    def handle(self, **options):
+        if options["repeat"] < 1:
+            raise CommandError("--repeat must be a positive number")
+        baseline = load_results(options["baseline"], self.results_version) if options["baseline"] else None
+        env = cpm_env()
+        executor = Executor()
+        execution_time = ExecutionTime()
+        results, regressions = {}, []
+        for arguments in self.commands:
+            argv = [sys.executable, "-X", "importtime", "-m", "cpm", *arguments]
+            wall, imports = [], []
+            for _ in range(options["repeat"]):
+                result = executor.run(argv, env=env)
+                if result.returncode != 0:
+                    raise CommandError("%s failed:\n%s" % (style_error(format_command(argv)),
+                                                          result.stderr))
+                wall.append(result.seconds)
+                imports = parse_importtime(result.stderr)
+            name = " ".join(arguments)
+            results[name] = {
+                "runs": wall,
+                "median": statistics.median(wall),
+                "min": min(wall),
+                "import_time": sum(self_us for _, self_us, _, _ in imports) / 1e6,
+                "cpm_import_time": sum(cumulative_us for module, _, cumulative_us, depth in imports
+                                       if depth == 0 and module.split(".")[0] == "cpm") / 1e6,
+                "modules": len(imports),
+                "slowest": [[module, self_us / 1e6] for module, self_us, _, _ in
+                            sorted(imports, key=lambda item: -item[1])[:options["top"]]],
+            }
+            line = "[ %s ] --- median %s min %s, imports %s (cpm %s) in %s modules" % (
+                style_success(name), execution_time.timeformat(results[name]["median"]),
+                execution_time.timeformat(results[name]["min"]),
+                execution_time.timeformat(results[name]["import_time"]),
+                execution_time.timeformat(results[name]["cpm_import_time"]), len(imports))
+            previous = (baseline or {}).get("results", {}).get(name)
+            if previous:
+                change = (results[name]["median"] - previous["median"]) / previous["median"] * 100
+                style = style_error if change > options["max_regression"] else style_success
+                line += " --- baseline %s (%s)" % (execution_time.timeformat(previous["median"]),
+                                                  style("%+.1f%%" % change))
+                if change > options["max_regression"]:
+                    regressions.append(name)
+            self.stdout.write(line)
+            for module, seconds in results[name]["slowest"]:
+                self.stdout.write("    %-40s %s" % (module, execution_time.timeformat(seconds)))
+        with open(options["output"], "w") as f:
+            json.dump({"version": self.results_version, "python": sys.version.split()[0],
+                       "results": results}, f, indent=2)
+        self.stdout.write("[ %s ] --- %s" % (style_success("results"), style_warning(options["output"])))
+        if regressions:
+            raise CommandError("startup of %s is more than %s%% slower than the baseline" % (
+                style_error(", ".join(regressions)), options["max_regression"]))
@@ -0,0 +1,18 @@
+from cpm.core.commands import run
+from cpm.core.color import colorize, style_success, style_cpm
+
+
+class Command(run.Command):
+    help = "Build c++ {project} without running it".format(
+        project=colorize("project", fg="blue", opts=("bold",)))
+    description = "Builds c++ project."
+
+    def add_program_arguments(self, parser):
+        # the program is never run
+        pass
+
+    def run_program(self, exe_name, new_terminal=False):
+        self.stdout.write("[ %s ] --- %s" % (style_success("built"), style_cpm(exe_name)))
+
+    def start_program(self, exe_name):
+        self.run_program(exe_name)
@@ -0,0 +1,55 @@
+import os
+import json
+from json import JSONDecodeError
+from cpm.core.base import BaseCommand
+from cpm.core.cache import ObjectCache, get_max_size, RESTORE_METHODS
+from cpm.core.color import colorize, style_success, style_warning
+
+
+class Command(BaseCommand):
+    help = "Manage the shared {cache} of compiled objects".format(
+        cache=colorize("cache", fg="blue", opts=("bold",)))
+    description = "Manages the build cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('stats', 'prune'),
+                            help='Cache operation to run.')
+
+    def handle(self, **options):
+        cache = ObjectCache(max_size=get_max_size(self.load_cpm_config(os.getcwd())))
+        getattr(self, "handle_%s" % options["action"])(cache)
+
+    def handle_stats(self, cache):
+        stats = cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = 100.0 * stats["hits"] / lookups if lookups else 0.0
+        self.stdout.write("cache directory   %s" % style_warning(cache.cache_dir))
+        self.stdout.write("objects           %s" % stats["objects"])
+        self.stdout.write("cache size        %s / %s" % (
+            format_size(stats["size"]), format_size(stats["max_size"])))
+        self.stdout.write("hits              %s" % style_success(str(stats["hits"])))
+        self.stdout.write("misses            %s" % style_warning(str(stats["misses"])))
+        self.stdout.write("hit rate          %.1f%%" % hit_rate)
+        self.stdout.write("restored by       %s" % ", ".join(
+            "%s %s" % (method, stats[method]) for method in RESTORE_METHODS))
+        self.stdout.write("bytes saved       %s" % format_size(stats["bytes_saved"]))
+
+    def handle_prune(self, cache):
+        evicted, size = cache.prune()
+        self.stdout.write("%s %s objects, cache size %s / %s" % (
+            style_success("evicted"), evicted, format_size(size), format_size(cache.max_size)))
+
+    def load_cpm_config(self, directory):
+        # the cache cap may be set per project, outside a project the defaults apply
+        try:
+            with open(os.path.join(directory, "cpm.json")) as cpm_config:
+                return json.load(cpm_config)
+        except (FileNotFoundError, JSONDecodeError):
+            return None
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return "%.1f %s" % (size, unit) if unit != "B" else "%d B" % size
+        size /= 1024
@@ -0,0 +1,163 @@
+import os
+import glob
+import shutil
+import statistics
+from cpm.core.color import colorize, style_error, style_success, style_warning, style_cpm
+from cpm.core.commands import run
+from cpm.core.executor import format_command
+from cpm.utils.base import ExecutionTime
+from cpm.utils.exceptions import CommandError
+
+
+class Command(run.Command):
+    help = "Build c++ {project} with profile-guided and link-time optimization".format(
+        project=colorize("project", fg="blue", opts=("bold",)))
+    description = "Builds c++ project with PGO and LTO."
+    # archivers able to index LTO objects, by compiler family
+    lto_archivers = {"gcc": "gcc-ar", "clang": "llvm-ar"}
+
+    def add_arguments(self, parser):
+        parser.add_argument('cpp_file_name', nargs='?',
+                            help='Name of the c++ file.')
+        parser.add_argument('--input', '-i', dest='inputs', action='append', required=True,
+                            metavar='PATH',
+                            help='Training input fed to the program on stdin; a directory adds '
+                                 'every file in it except the expected outputs (*.out). Repeat '
+                                 'for several inputs.')
+        parser.add_argument('--profile', '-p', dest='profile', default='release',
+                            help='Build profile the PGO build starts from and is compared with '
+                                 '(default: release).')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Runs of each input per binary when comparing them (default: 3).')
+        parser.add_argument('--jobs', '-j', dest='jobs', type=int, default=os.cpu_count() or 1,
+                            help='Number of translation units to compile in parallel '
+                                 '(default: number of CPUs).')
+
+    def handle(self, **options):
+        if options["jobs"] < 1:
+            raise CommandError("--jobs must be a positive number, got %s" %
+                               style_error(str(options["jobs"])))
+        if options["repeat"] < 1:
+            raise CommandError("--repeat must be a positive number")
+        current_dir, cpp_file_name, cpm_json = self.load_project(options["cpp_file_name"])
+        inputs = self.get_inputs(options["inputs"])
+        base, base_profile = self.get_profile(cpm_json, options["profile"])
+        pgo = "pgo-%s" % base
+        family = self.compiler_family()
+        jobs = options["jobs"]
+
+        self.stdout.write("[ %s ] --- profile %s" % (style_success("baseline"), style_warning(base)))
+        baseline = self.build(current_dir, cpp_file_name, cpm_json, jobs, self.get_cache(cpm_json),
+                              profile=base, shared=False)
+
+        # instrumented and optimized objects share build/pgo-<profile>/: gcc
+        # finds the .gcda of an object next to it. The object cache is left
+        # out, it knows nothing of the profile data an object was built with.
+        data_dir = os.path.join(self.get_build_dir(current_dir, pgo), "profile")
+        generate, use = self.get_pgo_flags(family, data_dir)
+        self.stdout.write("[ %s ] --- %s" % (style_success("instrument"), " ".join(generate)))
+        instrumented = self.build(current_dir, cpp_file_name,
+                                  self.with_profile(cpm_json, pgo, base_profile, generate),
+                                  jobs, profile=pgo, shared=False)
+        self.clear_profile_data(self.get_build_dir(current_dir, pgo), data_dir)
+        for path in inputs:
+            seconds = self.run_input(instrumented, path)
+            self.stdout.write("[ %s ] --- %s" % (style_success("train"), style_cpm(path)),
+                              ending=" %s\n" % ExecutionTime().timeformat(seconds))
+        self.merge_profile_data(family, data_dir)
+
+        self.stdout.write("[ %s ] --- %s" % (style_success("optimize"), " ".join(use)))
+        if shutil.which(self.lto_archivers[family]):
+            self.archiver = self.lto_archivers[family]
+        optimized = self.build(current_dir, cpp_file_name,
+                               self.with_profile(cpm_json, pgo, base_profile, use),
+                               jobs, profile=pgo, shared=False)
+        self.compare(baseline, optimized, inputs, options["repeat"])
+
+    def get_inputs(self, paths):
+        """Return the training inputs: the given files and the files of the given directories."""
+        inputs = []
+        for path in paths:
+            if os.path.isdir(path):
+                inputs.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                              if not name.endswith(".out") and os.path.isfile(os.path.join(path, name)))
+            elif os.path.isfile(path):
+                inputs.append(path)
+            else:
+                raise CommandError("input does not exist: %s" % style_error(path))
+        if not inputs:
+            raise CommandError("no training input in %s" % style_error(", ".join(paths)))
+        return inputs
+
+    def compiler_family(self):
+        """Return "clang" when the compiler is clang (g++ is on macOS), else "gcc"."""
+        result = self.executor.run([self.compiler, "--version"])
+        if result.returncode != 0:
+            raise CommandError("%s failed:\n%s" % (style_error(self.compiler), result.output))
+        return "clang" if "clang" in result.stdout else "gcc"
+
+    def get_pgo_flags(self, family, data_dir):
+        """Return the flags of the instrumented and of the optimized build."""
+        if family == "clang":
+            return (["-fprofile-generate=%s" % data_dir],
+                    ["-fprofile-use=%s" % os.path.join(data_dir, "default.profdata"), "-flto"])
+        # gcc counters of parallel threads are updated atomically, and the
+        # sources the training never reached are not worth a warning each
+        return (["-fprofile-generate", "-fprofile-update=prefer-atomic"],
+                ["-fprofile-use", "-fprofile-correction", "-Wno-missing-profile", "-flto"])
+
+    def clear_profile_data(self, build_dir, data_dir):
+        """Remove the profile data of earlier training runs."""
+        for path in glob.glob(os.path.join(build_dir, "**", "*.gcda"), recursive=True):
+            os.remove(path)
+        shutil.rmtree(data_dir, ignore_errors=True)
+        os.makedirs(data_dir)
+
+    def merge_profile_data(self, family, data_dir):
+        """
+        Merge the profile data of the training runs. gcc merges the counters
+        of every run into the .gcda files itself; clang writes one .profraw
+        per run, merged by llvm-profdata.
+        """
+        if family != "clang":
+            return
+        raw = sorted(glob.glob(os.path.join(data_dir, "*.profraw")))
+        if not raw:
+            raise CommandError("the training runs wrote no profile data to %s" % style_error(data_dir))
+        argv = ["llvm-profdata", "merge", "-output=%s" % os.path.join(data_dir, "default.profdata"), *raw]
+        result = self.executor.run(argv)
+        if result.returncode != 0:
+            raise CommandError("%s failed:\n%s" % (style_error(format_command(argv)), result.output))
+        self.stdout.write("[ %s ] --- %s runs" % (style_success("merge"), len(raw)))
+
+    def run_input(self, exe_name, path):
+        """Run the program with ``path`` on stdin; return its wall time."""
+        with open(path, "rb") as stdin:
+            result = self.executor.run([os.path.abspath(exe_name)], stdin=stdin)
+        if result.returncode != 0:
+            raise CommandError("%s exited with %s on %s:\n%s" % (
+                style_error(exe_name), result.returncode, style_error(path), result.stderr))
+        return result.seconds
+
+    def compare(self, baseline, optimized, inputs, repeat):
+        """Print the median runtime of both binaries on every input, then in total."""
+        totals = {baseline: 0.0, optimized: 0.0}
+        for path in inputs:
+            medians = {}
+            for exe_name in totals:
+                medians[exe_name] = statistics.median(self.run_input(exe_name, path)
+                                                      for _ in range(repeat))
+                totals[exe_name] += medians[exe_name]
+            self.stdout.write("[ %s ] --- %s" % (style_warning("compare"), style_cpm(path)),
+                              ending=" %s\n" % self.format_change(medians[baseline],
+                                                                  medians[optimized]))
+        self.stdout.write("[ %s ] --- %s -> %s" % (
+            style_success("pgo"), style_cpm(baseline), style_cpm(optimized)),
+            ending=" %s\n" % self.format_change(totals[baseline], totals[optimized]))
+
+    def format_change(self, before, after):
+        execution_time = ExecutionTime()
+        change = (after - before) / before * 100 if before else 0.0
+        style = style_error if change > 0 else style_success
+        return "%s -> %s (%s)" % (execution_time.timeformat(before), execution_time.timeformat(after),
+                                  style("%+.1f%%" % change))
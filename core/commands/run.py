@@ -1,7 +1,17 @@
 import os
+import sys
+import glob
 import json
+import fnmatch
+import time
+import shlex
+import shutil
+import signal
+import tempfile
 from json import JSONDecodeError
 import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from cpm.core.base import BaseCommand, CommandError
 from cpm.core.color import colorize, style_error, style_success, style_warning, style_cpm
 from cpm.utils.exceptions import (
@@ -12,6 +22,23 @@ from cpm.utils.exceptions import (
     CompileError,
 )
 from cpm.utils.base import ExecutionTime
+from cpm.core.manifest import BuildManifest, compiler_identity, parse_depfile
+from cpm.core.cache import ObjectCache, get_max_size, parse_size, RESTORE_METHODS, COMPANION_SUFFIXES
+from cpm.core.commands.cache import format_size
+from cpm.core.watch import get_watcher
+from cpm.core.graph import AppGraph
+from cpm.core.index import SourceIndex
+from cpm.core.executor import Executor, format_command
+from cpm.core.trace import NullTracer, Tracer
+from cpm.core.ninja import NinjaWriter, escape, stamp_of, write_if_changed
+from cpm.core.profiler import (
+    PROFILERS, get_profiler, parse_gprof_flat, parse_gprof_call_graph, parse_perf_report,
+)
+
+
+def app_name_of(archive):
+    """Return the library name of a ``lib<name>.a`` archive or ``lib<name>.so`` library."""
+    return os.path.splitext(os.path.basename(archive))[0][len("lib"):]
 
 
 class Command(BaseCommand):
@@ -21,22 +48,192 @@ class Command(BaseCommand):
     source_file_suffixes = (".cpp",)
     lib_file_suffixes = (".a", ".o", ".so", ".dll")
     rewrite_template_suffixes = (
-        ('.cpp', '.a'),
+        ('.cpp', '.o'),
     )
+    archiver = "ar"
 
     source = "source"
+    compiler = "g++"
+    unity_batch_size = 16
+    backends = ("cpm", "ninja")
+    ninja_file = "build.ninja"
+    # built-in build profiles, cpm.json "profiles" adds to and overrides them
+    profiles = {
+        "debug": {"flags": ["-O0", "-g"]},
+        "release": {"flags": ["-O2", "-DNDEBUG"]},
+        "native": {"flags": ["-O3", "-march=native"]},
+    }
+    default_profile = "debug"
+    # linkers cpm.json "linker" can pick, fastest first for "auto"
+    linkers = ("mold", "lld", "gold", "bfd")
+    # flags of the builds instrumented for a profiler, and the functions it reports
+    profiler_flags = {"gprof": ["-pg"], "perf": ["-fno-omit-frame-pointer"]}
+    profile_top = 15
 
     executionTime_class = ExecutionTime()
+    executor_class = Executor
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # every compile, archive and link step runs through the executor
+        self.executor = self.executor_class()
+        self.tracer = NullTracer()
+        self.time_trace = False
+        self.profile, self.profile_flags = self.get_profile({})
+        self.link_flags = self.profile_flags["link_flags"]
+        self.shared = False
 
     def add_arguments(self, parser):
         parser.add_argument('cpp_file_name', nargs='?',
                             help='Name of the c++ file.')
         parser.add_argument('--new-terminal', '--n-t', dest='new_terminal', action='store_true',
                             help='Open new terminal.')
+        parser.add_argument('--jobs', '-j', dest='jobs', type=int, default=os.cpu_count() or 1,
+                            help='Number of translation units to compile in parallel '
+                                 '(default: number of CPUs).')
+        parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                            help='Do not use the shared object cache.')
+        parser.add_argument('--watch', '-w', dest='watch', action='store_true',
+                            help='Rebuild and restart the program whenever a source changes.')
+        parser.add_argument('--no-pch', dest='no_pch', action='store_true',
+                            help='Compile without the precompiled headers declared in cpm.json.')
+        parser.add_argument('--unity', dest='unity', action='store_true',
+                            help='Compile the sources of every app in unity (jumbo) batches.')
+        parser.add_argument('--unity-batch-size', dest='unity_batch_size', type=int,
+                            help='Number of sources per unity batch (default: %s).'
+                                 % self.unity_batch_size)
+        parser.add_argument('--backend', dest='backend', choices=self.backends,
+                            help='Build executor: cpm itself or a generated build.ninja run by '
+                                 'ninja (default: "backend" of cpm.json, else cpm).')
+        parser.add_argument('--profile', '-p', dest='profile',
+                            help='Build profile: debug, release, native or one of the "profiles" '
+                                 'of cpm.json (default: "profile" of cpm.json, else %s). Every '
+                                 'profile builds in its own build/<profile>/ directory.'
+                                 % self.default_profile)
+        parser.add_argument('--shared', dest='shared', action='store_true', default=None,
+                            help='Development mode: build every app as a shared library '
+                                 '(lib<app>.so, -fPIC), so changing an app relinks only that '
+                                 'library (default: "shared" of cpm.json).')
+        parser.add_argument('--no-daemon', dest='no_daemon', action='store_true',
+                            help='Build in this process even when a cpm serve daemon is running.')
+        parser.add_argument('--trace', dest='trace', metavar='FILE',
+                            help='Write a Chrome trace (chrome://tracing, Perfetto) of every '
+                                 'build phase to FILE.')
+        self.add_program_arguments(parser)
+
+    def add_program_arguments(self, parser):
+        """Add the options about running the built program."""
+        parser.add_argument('--profile-program', dest='profile_program', nargs='?', const='auto',
+                            choices=('auto',) + PROFILERS, metavar='PROFILER',
+                            help='Build the program for a profiler in its own build directory, '
+                                 'run it and show its hotspots: perf (-fno-omit-frame-pointer) or '
+                                 'gprof (-pg); auto picks perf when it is installed.')
+        parser.add_argument('--inputs', dest='inputs', metavar='DIR',
+                            help='Run the program on every file of DIR (on stdin) in parallel and '
+                                 'compare each output with the expected <input>.out next to it.')
+        parser.add_argument('--workers', dest='workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of inputs run at once with --inputs (default: number of '
+                                 'CPUs).')
+        parser.add_argument('--timeout', dest='timeout', type=float, metavar='SECONDS',
+                            help='Kill a run of --inputs after SECONDS.')
+        parser.add_argument('--memory-limit', dest='memory_limit', metavar='SIZE',
+                            help='Cap the address space of every run of --inputs, e.g. 256M '
+                                 '(Unix only).')
 
     def handle(self, **options):
         cpp_file_name = options.pop("cpp_file_name")
         new_terminal = options.pop("new_terminal")
+        watch = options.pop("watch")
+        profile_program = options.pop("profile_program", None)
+        inputs = self.pop_input_options(options)
+        if inputs is not None and (watch or profile_program or new_terminal):
+            raise CommandError("--inputs cannot be combined with --watch, --profile-program "
+                               "or --new-terminal")
+        jobs, no_cache, build_options = self.pop_build_options(options)
+        trace = options.pop("trace")
+        if trace:
+            self.tracer = Tracer(trace)
+            self.time_trace = self.supports_time_trace()
+        try:
+            with self.tracer.span("load cpm.json", "config"):
+                current_dir, cpp_file_name, cpm_json = self.load_project(cpp_file_name)
+            if profile_program:
+                return self.profile_program(current_dir, cpp_file_name, cpm_json, jobs, no_cache,
+                                            profile_program, **build_options)
+            if watch:
+                return self.watch(current_dir, cpp_file_name, cpm_json, jobs, no_cache,
+                                  **build_options)
+            exe_name = self.build(current_dir, cpp_file_name, cpm_json, jobs,
+                                  self.get_cache(cpm_json, no_cache), **build_options)
+            if inputs is not None:
+                return self.run_inputs(current_dir, exe_name, **inputs)
+            self.run_program(exe_name, new_terminal)
+        finally:
+            if trace:
+                self.tracer.save()
+                self.stdout.write("[ %s ] --- %s" % (style_success("trace"), style_warning(trace)))
+
+    def pop_build_options(self, options):
+        """
+        Pop and check the options controlling the build; return ``(jobs,
+        no_cache, build_options)`` where ``build_options`` are keyword
+        arguments of build().
+        """
+        jobs = options.pop("jobs")
+        if jobs < 1:
+            raise CommandError("--jobs must be a positive number, got %s" % style_error(str(jobs)))
+        no_cache = options.pop("no_cache")
+        build_options = {
+            "use_pch": not options.pop("no_pch"),
+            "unity": options.pop("unity"),
+            "unity_batch_size": options.pop("unity_batch_size"),
+            "backend": options.pop("backend"),
+            "profile": options.pop("profile"),
+            "shared": options.pop("shared"),
+        }
+        if build_options["unity_batch_size"] is not None and build_options["unity_batch_size"] < 1:
+            raise CommandError("--unity-batch-size must be a positive number")
+        # only meaningful to the cpm serve client, which forwards the command line
+        options.pop("no_daemon", None)
+        return jobs, no_cache, build_options
+
+    def pop_input_options(self, options):
+        """
+        Pop and check the options of ``--inputs``; return the keyword
+        arguments of run_inputs(), or None without ``--inputs``.
+        """
+        inputs_dir = options.pop("inputs", None)
+        run_options = {
+            "workers": options.pop("workers", 1),
+            "timeout": options.pop("timeout", None),
+            "memory_limit": options.pop("memory_limit", None),
+        }
+        if inputs_dir is None:
+            return None
+        if not os.path.isdir(inputs_dir):
+            raise CommandError("inputs directory does not exist: %s" % style_error(inputs_dir))
+        if not hasattr(os, "wait4"):
+            raise CommandError("--inputs reads the resource usage of os.wait4, "
+                               "which this platform does not have")
+        if run_options["workers"] < 1:
+            raise CommandError("--workers must be a positive number, got %s" %
+                               style_error(str(run_options["workers"])))
+        if run_options["timeout"] is not None and run_options["timeout"] <= 0:
+            raise CommandError("--timeout must be a positive number of seconds")
+        if run_options["memory_limit"] is not None:
+            run_options["memory_limit"] = parse_size(run_options["memory_limit"])
+            if run_options["memory_limit"] <= 0:
+                raise CommandError("--memory-limit must be a positive size")
+        return dict(run_options, inputs_dir=inputs_dir)
+
+    def supports_time_trace(self):
+        """Return True if the compiler writes ``-ftime-trace`` reports (clang does, g++ does not)."""
+        result = self.executor.run([self.compiler, "-ftime-trace", "-fsyntax-only", "-x", "c++",
+                                    os.devnull])
+        return result.returncode == 0
+
+    def load_project(self, cpp_file_name=None):
+        """Return the project directory, its entry point and its cpm.json."""
         if cpp_file_name is None:
             current_dir = os.getcwd()
             self.validate(current_dir)
@@ -51,103 +248,1118 @@ class Command(BaseCommand):
             current_dir = os.path.join(os.getcwd())
             self.validate(current_dir, cpp_file_name)
             cpm_json = self.load_cpm_config(current_dir)
+        return current_dir, cpp_file_name, cpm_json
 
-        apps = self.get_app(cpm_json)
-        if apps is not None:
-            lib_files = ""
-            for app in apps:
-                try:
-                    self.validate_app(current_dir, app["name"])
-                except KeyError:
-                    raise KeyWordNotFoundError(style_error(
-                        "App name not found in cpm.json file"))
-                lib_dir = app.get("lib_dir", self.source)
-                source_files = self._get_lib_files(
-                    current_dir, app["name"], lib_dir)
-                if len(source_files.items()) != 0:
-                    self.stdout.write(
-                        "[ %s ] --- %s" % (style_success("build"), style_warning(app["name"])), ending="")
-                    lib_files += "".join(self._optimize_code_genrate(
-                        current_dir, source_files)) + " "
+    def get_profile(self, cpm_json, name=None):
+        """
+        Return the name and the settings of the build profile ``name``, the
+        default profile of cpm.json when None. A profile has the "flags" every
+        unit (and the entry point) is compiled with and the "link_flags" of
+        the executable, as lists or strings. Profiles with debug info write
+        it to a ``.dwo`` next to each object (``-gsplit-dwarf``), which the
+        linker never reads, unless their "split_dwarf" is false.
+        """
+        name = name or cpm_json.get("profile", self.default_profile)
+        profiles = dict(self.profiles, **cpm_json.get("profiles", {}))
+        if name not in profiles:
+            raise CommandError("unknown profile %s, expected one of: %s" % (
+                style_error(name), ", ".join(sorted(profiles))))
+        if os.path.basename(name) != name or name.startswith("."):
+            raise CommandError("profile name %s is not a valid directory name" % style_error(name))
+        profile = {}
+        for key in ("flags", "link_flags"):
+            value = profiles[name].get(key, [])
+            profile[key] = shlex.split(value) if isinstance(value, str) else list(value)
+        debug_info = [flag for flag in profile["flags"] if flag.startswith("-g")]
+        if (profiles[name].get("split_dwarf", True) and debug_info and debug_info[-1] != "-g0"
+                and "-gsplit-dwarf" not in profile["flags"] and os.name != "nt"):
+            profile["flags"].append("-gsplit-dwarf")
+        return name, profile
+
+    def get_linker_flags(self, cpm_json):
+        """
+        Return the flags selecting the linker named by the "linker" of
+        cpm.json: one of ``linkers``, or "auto" for the fastest one installed.
+        Without it, or when the linker is not installed, the compiler's
+        default linker is used.
+        """
+        linker = cpm_json.get("linker")
+        if linker is None:
+            return []
+        if linker == "auto":
+            installed = [name for name in self.linkers if self.linker_is_installed(name)]
+            return ["-fuse-ld=%s" % installed[0]] if installed else []
+        if linker not in self.linkers:
+            raise CommandError("unknown linker %s in cpm.json, expected one of: auto, %s" % (
+                style_error(linker), ", ".join(self.linkers)))
+        if not self.linker_is_installed(linker):
+            self.stdout.write("[ %s ] --- %s is not installed, linking with the default linker" % (
+                style_warning("linker"), style_warning(linker)))
+            return []
+        return ["-fuse-ld=%s" % linker]
+
+    def linker_is_installed(self, name):
+        return any(shutil.which(program) is not None for program in
+                   ["ld.%s" % name, *(["mold"] if name == "mold" else [])])
+
+    def get_linker_name(self):
+        """Return the name of the linker the link flags select."""
+        for flag in reversed(self.link_flags):
+            if flag.startswith("-fuse-ld="):
+                return flag[len("-fuse-ld="):]
+        return "default"
+
+    def get_build_dir(self, current_dir, profile=None):
+        """Return the build directory of a profile, the current one when None."""
+        return os.path.join(current_dir, "build", profile or self.profile)
+
+    def get_executable(self, cpp_file_name, profile=None):
+        """Return the path of the executable of an entry point, relative to the project."""
+        return os.path.join("build", profile or self.profile,
+                            cpp_file_name.rpartition(".")[0] + ".exe")
+
+    def with_profile(self, cpm_json, name, base_profile, flags):
+        """Return ``cpm_json`` with a profile ``name``: ``base_profile`` plus ``flags``."""
+        profiles = dict(cpm_json.get("profiles", {}))
+        profiles[name] = {"flags": base_profile["flags"] + flags,
+                          "link_flags": base_profile["link_flags"]}
+        return dict(cpm_json, profiles=profiles)
+
+    def get_cache(self, cpm_json, no_cache=False):
+        if no_cache or not cpm_json.get("cache", True):
+            return None
+        return ObjectCache(max_size=get_max_size(cpm_json))
+
+    def get_source_files(self, current_dir, cpm_json):
+        """
+        Return every source file of every app, mapped to its app name. The
+        source directories are listed through the index kept in build/.
+        """
+        source_files = {}
+        index = SourceIndex(os.path.join(current_dir, "build"))
+        for app in self.get_app(cpm_json) or ():
+            try:
+                self.validate_app(current_dir, app["name"])
+            except KeyError:
+                raise KeyWordNotFoundError(style_error(
+                    "App name not found in cpm.json file"))
+            source_files.update(self.get_app_files(current_dir, app, index))
+        index.save()
+        return source_files
+
+    def get_app_files(self, current_dir, app, index=None):
+        """
+        Return the source files of one app, mapped to its name. Globs of the
+        app's "include_sources" (when given) select the sources to build and
+        globs of its "exclude_sources" leave sources out; both are relative
+        to the app directory, e.g. "source/generated/*" or "*_test.cpp".
+        """
+        return self._get_lib_files(current_dir, app["name"], app.get("lib_dir", self.source),
+                                   index, app.get("include_sources", ()),
+                                   app.get("exclude_sources", ()))
+
+    def get_pch(self, current_dir, cpm_json):
+        """Return the precompiled header of every app declaring a "pch"."""
+        pch = {}
+        for app in self.get_app(cpm_json) or ():
+            if app.get("pch"):
+                header = os.path.join(current_dir, app["name"], app["pch"])
+                self.validate(os.path.join(current_dir, app["name"]), app["pch"])
+                pch[app["name"]] = os.path.abspath(header)
+        return pch
+
+    def build(self, current_dir, cpp_file_name, cpm_json, jobs=1, cache=None,
+              manifest=None, source_files=None, use_pch=True, unity=False, unity_batch_size=None,
+              backend=None, profile=None, shared=None):
+        """
+        Bring the executable of the project up to date and return its name.
+        ``manifest`` and ``source_files`` may be kept by callers that build
+        the same project repeatedly. With the ninja ``backend`` the build is
+        described in build.ninja and executed by ninja, when it is installed.
+        At most ``jobs`` compiler processes run at once. Everything is built
+        with the flags of the build ``profile``, into its own build directory;
+        a given ``manifest`` must be the one of that directory. With
+        ``shared`` (default: "shared" of cpm.json) apps are shared libraries
+        instead of static archives.
+        """
+        self.executor = self.executor_class(jobs)
+        self.profile, self.profile_flags = self.get_profile(cpm_json, profile)
+        self.link_flags = self.profile_flags["link_flags"] + self.get_linker_flags(cpm_json)
+        self.shared = cpm_json.get("shared", False) if shared is None else shared
+        if self.shared and os.name == "nt":
+            self.stdout.write("[ %s ] --- shared apps are not supported on Windows" %
+                              style_warning("shared"))
+            self.shared = False
+        backend = backend or cpm_json.get("backend", "cpm")
+        if backend not in self.backends:
+            raise CommandError("unknown backend %s in cpm.json, expected one of: %s" % (
+                style_error(backend), ", ".join(self.backends)))
+        if backend == "ninja" and self.shared:
+            self.stdout.write("[ %s ] --- shared apps are built by cpm" % style_warning("backend"))
+            backend = "cpm"
+        if manifest is None:
+            manifest = BuildManifest(self.get_build_dir(current_dir))
+        if source_files is None:
+            with self.tracer.span("scan sources", "scan"):
+                source_files = self.get_source_files(current_dir, cpm_json)
+        source_files = self.get_unity_sources(current_dir, cpm_json, source_files,
+                                              unity, unity_batch_size)
+        if backend == "ninja":
+            ninja = shutil.which("ninja")
+            if ninja is not None:
+                return self.build_ninja(ninja, current_dir, cpp_file_name, cpm_json, source_files,
+                                        jobs, self.get_pch(current_dir, cpm_json) if use_pch else None)
+            self.stdout.write("[ %s ] --- ninja is not installed, building with cpm" %
+                              style_warning("backend"))
+        archives = []
+        if len(source_files.items()) != 0:
+            # every translation unit of every app shares one job pool
+            archives = self._optimize_code_genrate(
+                current_dir, source_files, jobs, cpm_json.get('command'), cache, manifest,
+                self.get_pch(current_dir, cpm_json) if use_pch else None,
+                AppGraph(self.get_app(cpm_json)))
             self.stdout.write("combine compile %s" % style_cpm(cpp_file_name))
-            self.run_now(cpp_file_name, lib_files, cpm_json.get('command'), new_terminal)
-        else:
-            self.run_now(cpp_file_name, "", "", new_terminal)
+        return self.link_executable(cpp_file_name, archives, cpm_json.get('command'), manifest)
+
+    def get_unity_sources(self, current_dir, cpm_json, source_files, unity=False, batch_size=None):
+        """
+        Replace the sources of unity apps by generated unity translation units.
+
+        An app is built in unity mode with ``--unity`` or ``"unity": true``
+        (``"unity": false`` opts out of ``--unity``). Its sources are sorted
+        and batched into ``build/<app>/unity/__cpm_unity_<n>.cpp`` files that
+        ``#include`` them; the batch size comes from ``--unity-batch-size``,
+        the app's ``"unity_batch_size"`` or the class default. Sources matching
+        a glob of the app's ``"unity_exclude"`` (relative to the app directory)
+        keep being compiled on their own. A unity file is only rewritten when
+        its content changes, and its depfile lists the included sources, so
+        incremental builds keep working.
+        """
+        unity_sources = {}
+        apps = {app["name"]: app for app in self.get_app(cpm_json) or ()}
+        by_app = defaultdict(list)
+        for source_file, app_name in source_files.items():
+            by_app[app_name].append(source_file)
+        for app_name, sources in by_app.items():
+            app = apps.get(app_name, {})
+            if not app.get("unity", unity):
+                unity_sources.update(dict.fromkeys(sources, app_name))
+                continue
+            app_dir = os.path.join(current_dir, app_name)
+            exclude = app.get("unity_exclude", [])
+            batched = []
+            for source_file in sorted(sources):
+                relative = os.path.relpath(source_file, app_dir).replace(os.sep, "/")
+                if any(fnmatch.fnmatch(relative, pattern) for pattern in exclude):
+                    unity_sources[source_file] = app_name
+                else:
+                    batched.append(source_file)
+            size = batch_size or app.get("unity_batch_size", self.unity_batch_size)
+            unity_dir = os.path.join(self.get_build_dir(current_dir), app_name, "unity")
+            os.makedirs(unity_dir, exist_ok=True)
+            for number, start in enumerate(range(0, len(batched), size)):
+                unity_file = os.path.join(unity_dir, "__cpm_unity_%s.cpp" % number)
+                content = "".join('#include "%s"\n' % source_file.replace("\\", "/")
+                                  for source_file in batched[start:start + size])
+                if not os.path.exists(unity_file) or open(unity_file).read() != content:
+                    with open(unity_file, "w") as f:
+                        f.write(content)
+                unity_sources[unity_file] = app_name
+            for name in os.listdir(unity_dir):
+                # batches left over from a larger source set
+                if os.path.join(unity_dir, name) not in unity_sources:
+                    os.remove(os.path.join(unity_dir, name))
+        return unity_sources
+
+    def build_ninja(self, ninja, current_dir, cpp_file_name, cpm_json, source_files, jobs=1, pch=None):
+        """Build the project with ninja from the generated build.ninja; return the executable."""
+        build_file, written = self.generate_ninja(current_dir, cpp_file_name, cpm_json,
+                                                  source_files, pch)
+        self.stdout.write("[ %s ] --- %s" % (
+            style_success("generate" if written else "up-to-date"),
+            style_warning(os.path.relpath(build_file, current_dir))))
+        execution_time = ExecutionTime()
+        execution_time.start()
+        with self.tracer.span("ninja", "ninja", jobs=jobs):
+            process = self.executor.run([ninja, "-f", build_file, "-j", str(jobs)], cwd=current_dir,
+                                        capture=False)
+        execution_time.end()
+        if process.returncode != 0:
+            raise CompileError("ninja failed to build %s, see its output above" %
+                               style_warning(cpp_file_name))
+        self.stdout.write("[ %s ] --- %s" % (style_success("ninja"), style_cpm(cpp_file_name)),
+                          ending=f" {execution_time.get_execution_time()}\n")
+        return self.get_executable(cpp_file_name)
+
+    def generate_ninja(self, current_dir, cpp_file_name, cpm_json, source_files, pch=None):
+        """
+        Describe the build of the project in ``build/<profile>/build.ninja``:
+        one object per source under ``build/<profile>/ninja/<app>/`` with its
+        header dependencies read from the compiler's depfile, one
+        ``lib<app>.a`` per app and the link of the entry point with the flags
+        of the profile and the "command" flags of cpm.json. The file
+        starts with a stamp of everything it is generated from, and is only
+        rewritten when cpm.json or the source set changes. Return the path of
+        the file and whether it was written.
+        """
+        build_file = os.path.join(self.get_build_dir(current_dir), self.ninja_file)
+        ninja_dir = os.path.join(self.get_build_dir(current_dir), "ninja")
+        os.makedirs(ninja_dir, exist_ok=True)
+        flags = self.get_compile_flags()
+        pch = pch or {}
+        graph = AppGraph(self.get_app(cpm_json) or [])
+        stubs = {app_name: self._write_pch_stub(os.path.join(ninja_dir, app_name, "pch"), header)
+                 for app_name, header in pch.items() if app_name in source_files.values()}
+        stamp = stamp_of(json.dumps(cpm_json, sort_keys=True), cpp_file_name,
+                         sorted(source_files.items()), flags, self.link_flags,
+                         sorted(pch.items()), self.compiler, self.archiver)
+
+        def relative(path):
+            return os.path.relpath(path, current_dir)
+
+        def generate():
+            writer = NinjaWriter()
+            writer.comment("generated by cpm from cpm.json, changes are overwritten")
+            writer.variable("ninja_required_version", "1.3")
+            writer.variable("builddir", relative(ninja_dir))
+            writer.variable("cxx", self.compiler)
+            writer.variable("ar", self.archiver)
+            writer.variable("cflags", [escape(flag) for flag in flags])
+            writer.newline()
+            writer.rule("cxx", "$cxx -MMD -MF $out.d $cflags $appflags -c $in -o $out",
+                        description="CXX $out", depfile="$out.d", deps="gcc")
+            writer.rule("pch", "$cxx -MMD -MF $out.d $cflags $appflags -x c++-header -c $in -o $out",
+                        description="PCH $out", depfile="$out.d", deps="gcc")
+            if os.name == "nt":
+                archive_command = "cmd /c if exist $out del $out && $ar rcs $out $in"
+            else:
+                archive_command = "rm -f $out && $ar rcs $out $in"
+            # start from an empty archive so removed sources do not linger in it
+            writer.rule("ar", archive_command, description="AR $out")
+            writer.rule("link", "$cxx -o $out $in $libs $ldflags -MMD -MF $out.d",
+                        description="LINK $out", depfile="$out.d", deps="gcc")
+            members = defaultdict(list)
+            for source_file, app_name in sorted(source_files.items()):
+                members[app_name].append(source_file)
+            archives = {}
+            for app_name in graph.order:
+                if app_name not in members:
+                    continue
+                app_dir = os.path.join(ninja_dir, app_name)
+                # ninja runs from the project directory, keep the file relocatable
+                app_flags = self.get_include_flags(os.curdir, app_name, graph)
+                implicit = []
+                if app_name in stubs:
+                    gch = relative(stubs[app_name] + ".gch")
+                    writer.build([gch], "pch", [relative(stubs[app_name])],
+                                 variables={"appflags": app_flags})
+                    app_flags = app_flags + ["-include", relative(stubs[app_name]), "-Winvalid-pch"]
+                    implicit = [gch]
+                objects = []
+                for source_file in members[app_name]:
+                    objects.append(relative(os.path.join(app_dir, self.get_object_name(
+                        source_file, os.path.join(current_dir, app_name)))))
+                    writer.build([objects[-1]], "cxx", [relative(source_file)], implicit=implicit,
+                                 variables={"appflags": [escape(flag) for flag in app_flags]})
+                archives[app_name] = relative(os.path.join(app_dir, self.get_archive_name(app_name)))
+                writer.build([archives[app_name]], "ar", objects)
+            link_order = [archives[app_name] for app_name in graph.link_order(archives)]
+            exe_name = self.get_executable(cpp_file_name)
+            writer.build([exe_name], "link", [cpp_file_name], implicit=link_order, variables={
+                "libs": " ".join(self.get_link_args(link_order)),
+                "ldflags": [escape(flag) for flag in flags + self.link_flags] +
+                           [escape(cpm_json.get("command") or "")],
+            })
+            writer.default([exe_name])
+            return writer.getvalue()
+
+        return build_file, write_if_changed(build_file, stamp, generate)
+
+    def run_now(self, cpp_file_name, archives, commands, new_terminal=False):
+        exe_name = self.link_executable(cpp_file_name, archives, commands)
+        self.run_program(exe_name, new_terminal)
 
-    def run_now(self, cpp_file_name, lib_files, commands, new_terminal=False):
+    def link_executable(self, cpp_file_name, archives, commands, manifest=None):
+        """
+        Compile the entry point unless neither it nor the headers it includes
+        changed, then link the executable unless none of its inputs changed;
+        return its name.
+        """
         if commands is None:
             commands = ""
 
-        exe_name = cpp_file_name.rpartition(".")[0] + ".exe"
-        self.executionTime_class.start()
-        cpp_compile_command = f"g++ -o {exe_name} {cpp_file_name} {lib_files} {commands}"
-        compile_error = os.system(cpp_compile_command)
-        self.executionTime_class.end()
-        if compile_error != 0:
-            raise CompileError(f"Error in compiling file {style_warning(cpp_file_name)}:\n{style_error(cpp_compile_command)}")
+        exe_name = self.get_executable(cpp_file_name)
+        if manifest is None:
+            manifest = BuildManifest(self.get_build_dir(os.getcwd()))
+        os.makedirs(os.path.dirname(os.path.abspath(exe_name)), exist_ok=True)
+        os.makedirs(os.path.dirname(manifest.path), exist_ok=True)
+        executable = os.path.abspath(exe_name)
+        entry_object = os.path.splitext(executable)[0] + ".o"
+        compiler = compiler_identity(self.compiler)
+        flags = self.get_compile_flags() + shlex.split(commands, posix=os.name != "nt")
+        # recorded like a link: the manifest entries of sources are pruned to the source set
+        if manifest.link_is_stale(entry_object, [os.path.abspath(cpp_file_name)], compiler,
+                                  " ".join(flags)):
+            self.compile_entry_point(cpp_file_name, entry_object, flags, compiler, manifest)
+        # the executable only names shared apps: changing one does not relink it
+        inputs = [entry_object] if self.shared else [entry_object, *archives]
+        fingerprint = self.get_link_fingerprint(commands, archives)
+        if manifest.link_is_stale(executable, inputs, compiler, fingerprint):
+            self.link(exe_name, entry_object, archives, commands, manifest, inputs, fingerprint)
         else:
-            self.stdout.write("compile successfully.", style_success,
-                              ending=f" {self.executionTime_class.get_execution_time()}\n")
+            manifest.save()
+            self.stdout.write("[ %s ] --- %s" % (style_success("up-to-date"), style_warning(exe_name)))
+        return exe_name
+
+    def run_program(self, exe_name, new_terminal=False):
+        with self.tracer.span("run %s" % exe_name, "run"):
             if new_terminal:
                 self.stdout.write("opening new terminal", style_warning)
-                subprocess.run(
-                    f"{exe_name}", creationflags=subprocess.CREATE_NEW_CONSOLE)
+                self.executor.run([os.path.abspath(exe_name)], capture=False,
+                                  creationflags=subprocess.CREATE_NEW_CONSOLE)
             else:
-                os.system(f"{exe_name}")
+                self.executor.run([os.path.abspath(exe_name)], capture=False)
 
-    def _get_lib_files(self, directory, app_name, lib_dir):
+    def run_inputs(self, current_dir, exe_name, inputs_dir, workers=1, timeout=None, memory_limit=None):
+        """
+        Run the program on every file of ``inputs_dir`` but the expected
+        outputs (*.out), fed on stdin, ``workers`` runs at a time. A run is
+        killed after ``timeout`` seconds and its address space is capped at
+        ``memory_limit`` bytes. The output of an input ``a.in`` is compared
+        with ``a.out`` when there is one, ignoring trailing whitespace.
+        Print the time, peak memory and verdict of every input, then a
+        summary; raise CommandError when any of them did not pass.
+        """
+        inputs = [os.path.join(inputs_dir, name) for name in sorted(os.listdir(inputs_dir))
+                  if not name.endswith(".out") and os.path.isfile(os.path.join(inputs_dir, name))]
+        if not inputs:
+            raise CommandError("no input in %s" % style_error(inputs_dir))
+        self.executor = self.executor_class(workers)
+        argv = [os.path.abspath(exe_name)]
+
+        def run_input(path):
+            with open(path, "rb") as stdin, tempfile.TemporaryFile() as stdout:
+                measurement = self.executor.measure(argv, cwd=current_dir, stdin=stdin, stdout=stdout,
+                                                    timeout=timeout, memory_limit=memory_limit)
+                stdout.seek(0)
+                output = stdout.read().decode(errors="replace")
+            return measurement, output
+
+        verdicts = defaultdict(int)
+        total, peak = 0, None
+        with self.tracer.span("run %s on %s" % (exe_name, inputs_dir), "run"), \
+                ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                # results come back in input order, each as soon as it and those before it are done
+                for path, (measurement, output) in zip(inputs, pool.map(run_input, inputs)):
+                    verdict, detail = self.check_output(path, measurement, output)
+                    verdicts[verdict] += 1
+                    total += measurement.seconds
+                    if measurement.max_rss is not None:
+                        peak = max(peak or 0, measurement.max_rss)
+                    style = style_success if verdict in ("pass", "ok") else style_error
+                    self.stdout.write("[ %s ] --- %s" % (style(verdict), style_cpm(path)),
+                                      ending=" %s %s\n" % (self.executionTime_class.timeformat(
+                                          measurement.seconds), self.format_peak(measurement.max_rss)))
+                    if detail:
+                        self.stdout.write("    %s" % detail)
+            except BaseException:
+                self.executor.cancel()
+                raise
+        failed = sum(count for verdict, count in verdicts.items() if verdict not in ("pass", "ok"))
+        self.stdout.write("[ %s ] --- %s" % (
+            style_error("inputs") if failed else style_success("inputs"),
+            ", ".join("%s %s" % (count, verdict) for verdict, count in sorted(verdicts.items()))),
+            ending=" --- total %s, peak %s\n" % (self.executionTime_class.timeformat(total),
+                                                  self.format_peak(peak)))
+        if failed:
+            raise CommandError("%s of %s inputs did not pass" % (failed, len(inputs)))
+
+    def format_peak(self, max_rss):
+        """Format a peak memory, which is unknown for a killed run or without the measuring shim."""
+        return "-" if max_rss is None else format_size(max_rss)
+
+    def check_output(self, path, measurement, output):
+        """
+        Return the verdict of one run (pass, fail, ok when there is no
+        expected output, timeout or error) and a line explaining it.
+        """
+        if measurement.timed_out:
+            return "timeout", "killed after %s" % self.executionTime_class.timeformat(measurement.seconds)
+        if measurement.returncode != 0:
+            if measurement.returncode < 0:
+                try:
+                    reason = "killed by %s" % signal.Signals(-measurement.returncode).name
+                except ValueError:
+                    reason = "killed by signal %s" % -measurement.returncode
+            else:
+                reason = "exited with %s" % measurement.returncode
+            errors = measurement.stderr.strip().splitlines()
+            return "error", reason + (": %s" % errors[-1] if errors else "")
+        expected_file = os.path.splitext(path)[0] + ".out"
+        if not os.path.isfile(expected_file):
+            return "ok", None
+        with open(expected_file, encoding="utf-8", errors="replace") as f:
+            expected = [line.rstrip() for line in f.read().rstrip().splitlines()]
+        actual = [line.rstrip() for line in output.rstrip().splitlines()]
+        if actual == expected:
+            return "pass", None
+        for number, (want, got) in enumerate(zip(expected + [""] * len(actual),
+                                                 actual + [""] * len(expected)), 1):
+            if want != got:
+                return "fail", "line %s: expected %r, got %r (%s)" % (
+                    number, want, got, os.path.basename(expected_file))
+
+    def compile_entry_point(self, cpp_file_name, entry_object, flags, compiler, manifest):
+        """
+        Compile the entry point into ``entry_object`` and record it in
+        ``manifest`` with the headers it includes.
+        """
+        returncode, output, seconds = self._compile_source(cpp_file_name, entry_object, flags)
+        if returncode != 0:
+            raise CompileError(f"Error in compiling file {style_warning(cpp_file_name)}:\n{output}")
+        if output:
+            self.stdout.write(output)
+        manifest.record_link(entry_object, [os.path.abspath(cpp_file_name)], compiler, " ".join(flags),
+                             parse_depfile(self.get_depfile(entry_object)))
+        self.stdout.write("[ %s ] --- %s --- [ %s ]" % (
+            style_success("build"), style_cpm(cpp_file_name), style_warning(entry_object)),
+            ending=" %s\n" % self.executionTime_class.timeformat(seconds))
+
+    def link(self, exe_name, entry_object, archives, commands, manifest, inputs, fingerprint):
+        """
+        Link the entry object with the app ``archives``. The link is recorded
+        in ``manifest`` with its ``inputs`` and ``fingerprint``, so it is
+        skipped while none of them change, and timed on its own.
+        """
+        self.executionTime_class.start()
+        argv = [self.compiler, "-o", exe_name, entry_object, *self.get_link_args(archives, exe_name),
+                *self.get_compile_flags(), *self.link_flags,
+                *shlex.split(commands, posix=os.name != "nt")]
+        with self.tracer.span("link %s" % exe_name, "link", archives=archives,
+                              linker=self.get_linker_name()):
+            result = self.executor.run(argv)
+        self.executionTime_class.end()
+        if result.returncode != 0:
+            raise CompileError(f"Error in linking {style_warning(exe_name)}:\n"
+                               f"{style_error(format_command(argv))}\n{result.output}")
+        if result.output:
+            self.stdout.write(result.output)
+        manifest.record_link(os.path.abspath(exe_name), inputs, compiler_identity(self.compiler),
+                             fingerprint)
+        manifest.save()
+        self.stdout.write("[ %s ] --- %s --- %s linker" % (
+            style_success("link"), style_cpm(exe_name), self.get_linker_name()),
+            ending=f" {self.executionTime_class.get_execution_time()}\n")
+
+    def profile_program(self, current_dir, cpp_file_name, cpm_json, jobs=1, no_cache=False,
+                        profiler="auto", **build_options):
+        """
+        Build the program for ``profiler`` (perf or gprof, "auto" for the
+        first one installed) into its own ``build/<profile>-<profiler>/``
+        directory, so the instrumented objects never replace those of normal
+        builds; run it, then show its flat profile and a call graph summary.
+        """
+        tool = get_profiler(profiler)
+        if tool is None:
+            raise CommandError("%s is not installed" % style_error(
+                " or ".join(PROFILERS) if profiler == "auto" else profiler))
+        base, base_profile = self.get_profile(cpm_json, build_options.pop("profile"))
+        name = "%s-%s" % (base, tool)
+        # the profilers only see the code of the executable itself
+        build_options["shared"] = False
+        exe_name = self.build(current_dir, cpp_file_name,
+                              self.with_profile(cpm_json, name, base_profile, self.profiler_flags[tool]),
+                              jobs, self.get_cache(cpm_json, no_cache), profile=name, **build_options)
+        build_dir = self.get_build_dir(current_dir)
+        with self.tracer.span("profile %s" % exe_name, "run", profiler=tool):
+            if tool == "gprof":
+                report_file, flat, call_graph = self._profile_gprof(exe_name, build_dir)
+            else:
+                report_file, flat, call_graph = self._profile_perf(exe_name, build_dir)
+        self.stdout.write("[ %s ] --- %s --- %s" % (
+            style_success("profile"), style_cpm(tool), style_warning(os.path.relpath(report_file))))
+        for title, rows in (("flat profile, self time", flat),
+                            ("call graph, time with callees", call_graph)):
+            self.stdout.write("  %s" % title)
+            for percent, detail, function in rows[:self.profile_top]:
+                self.stdout.write("  %6.2f%%  %-24s %s" % (percent, detail, style_warning(function)))
+            if not rows:
+                self.stdout.write("  no samples, the program ran too briefly")
+
+    def _profile_gprof(self, exe_name, build_dir):
+        """Run the program built with -pg; return the report file, flat profile and call graph."""
+        prefix = os.path.join(build_dir, "gmon.out")
+        for path in glob.glob(prefix + ".*"):
+            os.remove(path)
+        result = self.executor.run([os.path.abspath(exe_name)], capture=False,
+                                   env=dict(os.environ, GMON_OUT_PREFIX=prefix))
+        if result.returncode != 0:
+            self.stdout.write("[ %s ] --- %s exited with %s" % (
+                style_warning("profile"), exe_name, result.returncode))
+        data = sorted(glob.glob(prefix + ".*"))
+        if not data:
+            raise CommandError("%s wrote no gmon.out: gprof needs the program to return from main "
+                               "or call exit()" % style_error(exe_name))
+        reports = []
+        for option in ("-p", "-q"):
+            argv = ["gprof", "-b", option, exe_name, *data]
+            report = self.executor.run(argv)
+            if report.returncode != 0:
+                raise CommandError("%s failed:\n%s" % (style_error(format_command(argv)), report.output))
+            reports.append(report.stdout)
+        report_file = os.path.join(build_dir, "gprof.txt")
+        with open(report_file, "w") as f:
+            f.write("\n".join(reports))
+        flat = [(percent, "%.2fs%s" % (seconds, " %s calls" % calls if calls is not None else ""), name)
+                for percent, seconds, calls, name in parse_gprof_flat(reports[0])]
+        call_graph = [(percent, "%.2fs + %.2fs" % (seconds, children), name)
+                      for percent, seconds, children, name in parse_gprof_call_graph(reports[1])]
+        return report_file, flat, call_graph
+
+    def _profile_perf(self, exe_name, build_dir):
+        """Record the program with perf; return the report file, flat profile and call graph."""
+        data = os.path.join(build_dir, "perf.data")
+        result = self.executor.run(["perf", "record", "--call-graph", "fp", "-o", data, "--",
+                                    os.path.abspath(exe_name)], capture=False)
+        if not os.path.exists(data):
+            raise CommandError("perf record failed, see its output above (perf_event_paranoid "
+                               "may forbid it, try --profile-program gprof)")
+        if result.returncode != 0:
+            self.stdout.write("[ %s ] --- %s exited with %s" % (
+                style_warning("profile"), exe_name, result.returncode))
+        argv = ["perf", "report", "-i", data, "--stdio", "--children", "--sort", "symbol", "-g", "none"]
+        report = self.executor.run(argv)
+        if report.returncode != 0:
+            raise CommandError("%s failed:\n%s" % (style_error(format_command(argv)), report.output))
+        report_file = os.path.join(build_dir, "perf.txt")
+        with open(report_file, "w") as f:
+            f.write(report.stdout)
+        rows = parse_perf_report(report.stdout)
+        flat = [(self_percent, "", name) for _, self_percent, name in
+                sorted(rows, key=lambda row: -row[1]) if self_percent > 0]
+        call_graph = [(children, "", name) for children, _, name in rows]
+        return report_file, flat, call_graph
+
+    def watch(self, current_dir, cpp_file_name, cpm_json, jobs=1, no_cache=False, **build_options):
+        """
+        Rebuild and restart the program whenever the entry point, cpm.json or
+        a file in an app's source/include directory changes. The project
+        model (cpm.json, source list, build manifest) stays in memory between
+        rebuilds; only the changed units are compiled again.
+        """
+        config_file = os.path.join(current_dir, "cpm.json")
+        entry_point = os.path.abspath(cpp_file_name)
+        manifests = {}
+        source_files = None
+        watcher = process = None
+        try:
+            while True:
+                try:
+                    if cpm_json is None:
+                        cpm_json = self.load_cpm_config(current_dir)
+                    if source_files is None:
+                        if watcher is not None:
+                            watcher.close()
+                            watcher = None
+                        source_files = self.get_source_files(current_dir, cpm_json)
+                    # the default profile may change with cpm.json
+                    profile = self.get_profile(cpm_json, build_options.get("profile"))[0]
+                    if profile not in manifests:
+                        manifests[profile] = BuildManifest(self.get_build_dir(current_dir, profile))
+                    manifest = manifests[profile]
+                    exe_name = self.build(current_dir, cpp_file_name, cpm_json, jobs,
+                                          self.get_cache(cpm_json, no_cache), manifest,
+                                          source_files, **build_options)
+                    process = self.start_program(exe_name)
+                except CommandError as e:
+                    self.stderr.write('%s: %s' % (e.__class__.__name__, e))
+                if watcher is None:
+                    # until cpm.json and the apps load, any change in the project may fix them
+                    roots = ([current_dir] if source_files is None else
+                             self.get_watch_roots(current_dir, cpm_json))
+                    watcher = get_watcher(roots, files=[entry_point, config_file],
+                                          ignore=[os.path.join(current_dir, "build")])
+                self.stdout.write("[ %s ] --- waiting for changes, press Ctrl+C to stop" %
+                                  style_warning("watch"))
+                changed = watcher.wait()
+                self.stop_program(process)
+                process = None
+                self.stdout.write("[ %s ] --- %s" % (style_warning("changed"), ", ".join(
+                    sorted(os.path.relpath(path, current_dir) for path in changed))))
+                if config_file in changed:
+                    cpm_json = source_files = None
+                elif source_files is None or any(self.changes_sources(path, source_files)
+                                                 for path in changed):
+                    # sources were added or removed: list the apps again
+                    source_files = None
+                for manifest in manifests.values():
+                    manifest.reset()
+        except KeyboardInterrupt:
+            self.stop_program(process)
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+    def changes_sources(self, path, source_files):
+        """
+        Whether the change of ``path`` may add or remove one of the
+        ``source_files``, so the source directories must be listed again.
+        """
+        if os.path.isdir(path):
+            # a directory was created or moved in
+            return True
+        if path.endswith(self.source_file_suffixes):
+            return (path in source_files) != os.path.exists(path)
+        # a directory of sources was removed or moved away
+        return not os.path.exists(path) and any(source_file.startswith(path + os.sep)
+                                                for source_file in source_files)
+
+    def get_watch_roots(self, current_dir, cpm_json):
+        roots = []
+        for app in self.get_app(cpm_json) or ():
+            for subdir in (app.get("lib_dir", self.source), "include"):
+                path = os.path.join(current_dir, app["name"], subdir)
+                if os.path.isdir(path):
+                    roots.append(path)
+        return roots
+
+    def start_program(self, exe_name):
+        return subprocess.Popen([os.path.abspath(exe_name)])
+
+    def stop_program(self, process):
+        if process is None or process.poll() is not None:
+            return
+        process.terminate()
+        try:
+            process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def _get_lib_files(self, directory, app_name, lib_dir, index=None, include=(), exclude=()):
         if not os.path.exists(os.path.join(directory, app_name, lib_dir)):
             raise DirectoryNotFoundError("'%s' directory is not exist in '%s'" %
                                          (style_error(lib_dir),
                                           style_error(os.path.join(directory, app_name))))
+        if index is None:
+            index = SourceIndex()
         # make list of all source files
+        app_dir = os.path.join(directory, app_name)
         source_files = {}
-        for root, dirs, files in os.walk(os.path.join(directory, app_name, lib_dir)):
-            for file in files:
-                if file.endswith(self.source_file_suffixes):
-                    source_files[str(os.path.join(root, file))] = app_name
+        for source_file in index.files(os.path.join(app_dir, lib_dir), self.source_file_suffixes):
+            relative = source_file[len(app_dir) + len(os.sep):].replace(os.sep, "/")
+            if include and not any(fnmatch.fnmatch(relative, pattern) for pattern in include):
+                continue
+            if any(fnmatch.fnmatch(relative, pattern) for pattern in exclude):
+                continue
+            source_files[source_file] = app_name
         return source_files
 
-    def _optimize_code_genrate(self, directory, source_files):
+    def _optimize_code_genrate(self, directory, source_files, jobs=1, commands=None, cache=None,
+                               manifest=None, pch=None, graph=None):
         """this function is used to optimize the code generation using g++
 
+        Translation units are compiled concurrently by a pool of ``jobs``
+        workers. Each job's compiler output is captured and written in one
+        piece, so lines from different jobs never interleave. Sources whose
+        object is up to date according to the build manifest are skipped, and
+        stale ones are restored from the shared object ``cache`` when possible.
+        Apps with a precompiled header get it built first (once per flag set)
+        and force-included in each of their sources. Apps are scheduled along
+        their ``depends_on`` graph: an app starts once its dependencies are
+        archived, independent apps compile side by side, and each app sees the
+        include directories of its dependencies. The objects of every app are
+        packed into a ``lib<app>.a`` static archive as soon as they are built.
+
         Args:
             directory ([str]) : [current directory]
-            source_files ([dict]) : [source files] 
+            source_files ([dict]) : [source files]
+            jobs ([int]) : [number of parallel compile jobs]
+            commands ([str]) : [extra flags from cpm.json "command"]
+            cache ([ObjectCache]) : [shared object cache, None to disable]
+            manifest ([BuildManifest]) : [build manifest, loaded from build/ if None]
+            pch ([dict]) : [app name -> precompiled header path]
+            graph ([AppGraph]) : [app dependency graph, no dependencies if None]
 
         Raises:
-            CompileError: [compile error]
+            CompileError: [compile error of the first failing file]
         Returns:
-            [list] : [optimized source files]
+            [list] : [paths of the app archives, in link order]
         """
-        optimized_source_files = ""
-        if not os.path.exists(os.path.join(directory, "build")):
-            os.mkdir(os.path.join(directory, "build"))
+        build_dir = self.get_build_dir(directory)
+        if not os.path.exists(build_dir):
+            os.makedirs(build_dir)
         # get app_name and app_dir
+        targets = {}
+        app_dirs = {}
         for source_file in source_files:
-            for old_suffix, new_suffix in self.rewrite_template_suffixes:
-                if source_file.endswith(old_suffix):
-                    lib_file = source_file[:-len(old_suffix)] + new_suffix
-                    break
-            # check file is exist or not than compile it
-            if not os.path.exists(os.path.join(directory, "build", source_files[source_file])):
-                os.mkdir(os.path.join(directory, "build",
-                         source_files[source_file]))
-            # command = "g++ -c -o %s %s" % (lib_file, source_file)
-
-            build_dir = os.path.join(
-                directory, "build", source_files[source_file], os.path.basename(lib_file))
-
-            self.executionTime_class.start()
-            build = os.system(f"g++ -c {source_file} -o {build_dir}")
-            self.executionTime_class.end()
-            self.stdout.write(f" --- [ {style_warning(build_dir)} ]",
-                              ending=f" {self.executionTime_class.get_execution_time()}\n")
-            optimized_source_files += "".join(build_dir) + " "
-            if build != 0:
-                raise CompileError("Error in compiling file %s" %
-                                   style_warning(source_file))
-        return optimized_source_files
+            app_name = source_files[source_file]
+            app_dirs[app_name] = os.path.join(build_dir, app_name)
+            # objects keep the path of their source in the app, so two sources
+            # with the same name in different directories never share one
+            targets[source_file] = os.path.join(
+                app_dirs[app_name], self.get_object_name(source_file, os.path.join(directory, app_name)))
+            os.makedirs(os.path.dirname(targets[source_file]), exist_ok=True)
+
+        if manifest is None:
+            manifest = BuildManifest(build_dir)
+        manifest.prune(targets)
+        compiler = compiler_identity(self.compiler)
+        flags = self.get_compile_flags()
+        # the "command" field of cpm.json is part of the fingerprint as well
+        fingerprint = flags + ["command:%s" % (commands or "")]
+        if graph is None:
+            graph = AppGraph([{"name": app_name} for app_name in dict.fromkeys(source_files.values())])
+        app_flags = {}
+        for app_name in set(source_files.values()):
+            app_flags[app_name] = flags + self.get_include_flags(directory, app_name, graph)
+        # the fingerprint keys the shared object cache: paths in it are relative
+        # to the project, so another checkout of it finds the same objects
+        app_fingerprint = {app_name: fingerprint + self.get_include_flags(os.curdir, app_name, graph)
+                           for app_name in app_flags}
+        pch_headers = {}
+        rebuilt_pch = set()
+        for app_name, header in (pch or {}).items():
+            if app_name not in app_flags:
+                continue
+            stub, rebuilt = self._build_pch(directory, app_name, header, app_flags[app_name],
+                                            compiler, app_fingerprint[app_name], manifest)
+            if rebuilt:
+                rebuilt_pch.add(app_name)
+            app_flags[app_name] = app_flags[app_name] + ["-include", stub, "-Winvalid-pch"]
+            app_fingerprint[app_name] = app_fingerprint[app_name] + [
+                "pch:%s" % os.path.relpath(header, directory).replace(os.sep, "/")]
+            # a source using the pch depends on everything the pch includes
+            pch_headers[app_name] = [header, *manifest.entries[stub]["headers"]]
+        stale = {source_file for source_file, build_dir in targets.items()
+                 if source_files[source_file] in rebuilt_pch or
+                 manifest.is_stale(source_file, build_dir, compiler,
+                                   app_fingerprint[source_files[source_file]])}
+        if len(stale) != len(targets):
+            self.stdout.write("[ %s ] --- %s of %s translation units" % (
+                style_success("up-to-date"), len(targets) - len(stale), len(targets)))
+
+        members = defaultdict(list)
+        for source_file in targets:
+            members[source_files[source_file]].append(source_file)
+        waiting = {app_name: [source_file for source_file in sources if source_file in stale]
+                   for app_name, sources in members.items()}
+        apps_left = [app_name for app_name in graph.order if app_name in members]
+        archives, started, durations = {}, {}, {}
+
+        def finish_app(app_name):
+            objects = [targets[source_file] for source_file in members[app_name]]
+            if self.shared:
+                archives[app_name] = self._link_shared_app(app_name, app_dirs[app_name], objects, [
+                    archives[dependency] for dependency in graph.depends_on[app_name]
+                    if dependency in archives], manifest)
+            else:
+                archives[app_name] = self._archive_app(app_name, app_dirs[app_name], objects, manifest)
+            durations[app_name] = time.perf_counter() - started[app_name]
+
+        failed = None
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {}
+            try:
+                while apps_left or futures:
+                    # start every app whose dependencies are archived, sources of
+                    # independent apps share the pool
+                    ready = [app_name for app_name in apps_left if all(
+                        dependency in archives or dependency not in members
+                        for dependency in graph.depends_on[app_name])]
+                    for app_name in ready:
+                        apps_left.remove(app_name)
+                        started[app_name] = time.perf_counter()
+                        for source_file in waiting[app_name]:
+                            futures[executor.submit(
+                                self._build_source, source_file, targets[source_file],
+                                app_flags[app_name], compiler, app_fingerprint[app_name], cache,
+                                pch_headers.get(app_name, ()))] = source_file
+                        if not waiting[app_name]:
+                            finish_app(app_name)
+                    if not futures:
+                        continue
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        source_file = futures.pop(future)
+                        if future.cancelled():
+                            continue
+                        returncode, output, seconds, headers, cached = future.result()
+                        app_name = source_files[source_file]
+                        build_dir = targets[source_file]
+                        if returncode != 0:
+                            if failed is None:
+                                failed = (source_file, output)
+                                # stop at the first failure: drop every job not started
+                                # yet and kill the compilers still running
+                                for pending in futures:
+                                    pending.cancel()
+                                self.executor.cancel()
+                                apps_left.clear()
+                            continue
+                        variant = "pch" if app_name in pch_headers else "no-pch"
+                        manifest.record(source_file, build_dir, compiler, app_fingerprint[app_name],
+                                        headers, None if cached else (variant, seconds))
+                        self.stdout.write("[ %s ] --- %s --- [ %s ]" % (
+                            style_success("cached" if cached else "build"),
+                            style_warning(app_name), style_warning(build_dir)),
+                            ending=" %s%s\n" % (self.executionTime_class.timeformat(seconds),
+                                                self._compare_pch_time(manifest, source_file, variant)))
+                        if output:
+                            self.stdout.write(output)
+                        waiting[app_name].remove(source_file)
+                        if not waiting[app_name] and failed is None:
+                            finish_app(app_name)
+            finally:
+                manifest.save()
+                if cache is not None:
+                    self._report_cache(cache)
+                    cache.flush()
+        if failed is not None:
+            source_file, output = failed
+            raise CompileError("Error in compiling file %s\n%s" %
+                               (style_warning(source_file), output))
+        if graph.has_dependencies():
+            seconds, path = graph.critical_path(durations)
+            self.stdout.write("[ %s ] --- %s" % (style_success("critical path"), " -> ".join(
+                style_warning(app_name) for app_name in path)),
+                ending=" %s\n" % self.executionTime_class.timeformat(seconds))
+        return [archives[app_name] for app_name in graph.link_order(archives)]
+
+    def _build_pch(self, directory, app_name, header, flags, compiler, fingerprint, manifest):
+        """
+        Precompile ``header`` of an app into ``build/<app>/pch/<header>.gch``.
+
+        Sources are compiled with ``-include build/<app>/pch/<header>``, a stub
+        that includes the real header: g++ picks the ``.gch`` next to it while
+        it is valid for the flags in use and falls back to the stub otherwise.
+        The pch is tracked in the manifest like a source (its own includes
+        come from its depfile). Return the stub path and whether the pch was
+        rebuilt.
+        """
+        stub = self._write_pch_stub(os.path.join(self.get_build_dir(directory), app_name, "pch"), header)
+        gch = stub + ".gch"
+        if not manifest.is_stale(stub, gch, compiler, fingerprint + ["pch:%s" % header]):
+            return stub, False
+        returncode, output, seconds = self._compile_source(stub, gch, flags, language="c++-header")
+        if returncode != 0:
+            raise CompileError("Error in precompiling header %s\n%s" %
+                               (style_warning(header), output))
+        manifest.record(stub, gch, compiler, fingerprint + ["pch:%s" % header],
+                        parse_depfile(self.get_depfile(gch)))
+        self.stdout.write("[ %s ] --- %s --- [ %s ]" % (
+            style_success("pch"), style_warning(app_name), style_warning(gch)),
+            ending=" %s\n" % self.executionTime_class.timeformat(seconds))
+        return stub, True
+
+    def _write_pch_stub(self, pch_dir, header):
+        """Write the stub including ``header`` into ``pch_dir`` when it changed; return its path."""
+        os.makedirs(pch_dir, exist_ok=True)
+        stub = os.path.join(pch_dir, os.path.basename(header))
+        content = '#include "%s"\n' % header.replace("\\", "/")
+        if not os.path.exists(stub) or open(stub).read() != content:
+            with open(stub, "w") as f:
+                f.write(content)
+        return stub
+
+    def _compare_pch_time(self, manifest, source_file, variant):
+        """Describe the last compile time of ``source_file`` in the other pch mode."""
+        other = "no-pch" if variant == "pch" else "pch"
+        seconds = manifest.entries[source_file].get("times", {}).get(other)
+        if seconds is None:
+            return ""
+        return " (%s %s)" % (self.executionTime_class.timeformat(seconds),
+                             "without pch" if other == "no-pch" else "with pch")
+
+    def get_object_name(self, source_file, app_dir=None):
+        """
+        Return the name of the object compiled from ``source_file``: its path
+        relative to ``app_dir`` when it lies in it, else its file name.
+        """
+        name = os.path.basename(source_file)
+        if app_dir is not None:
+            relative = os.path.relpath(source_file, app_dir)
+            if relative != os.pardir and not relative.startswith(os.pardir + os.sep):
+                name = relative
+        for old_suffix, new_suffix in self.rewrite_template_suffixes:
+            if name.endswith(old_suffix):
+                return name[:-len(old_suffix)] + new_suffix
+        return name
+
+    def get_include_flags(self, directory, app_name, graph):
+        """Return the include flags of the dependencies of an app."""
+        return ["-I%s" % os.path.join(directory, dependency, "include")
+                for dependency in graph.dependencies(app_name)]
+
+    def get_archive_name(self, app_name):
+        return "lib%s.a" % app_name
+
+    def _archive_app(self, app_name, app_dir, objects, manifest):
+        """
+        Pack the ``objects`` of an app into ``build/<profile>/<app>/lib<app>.a``
+        (``app_dir``). The archive is only rewritten when one of its members
+        changed. Return the archive path.
+        """
+        objects = sorted(objects)
+        archive = os.path.join(app_dir, self.get_archive_name(app_name))
+        # -l prefers the shared library of an earlier --shared build to the archive
+        shared_library = os.path.join(app_dir, self.get_shared_name(app_name))
+        if os.path.exists(shared_library):
+            os.remove(shared_library)
+        if not manifest.archive_is_stale(archive, objects):
+            return archive
+        execution_time = ExecutionTime()
+        execution_time.start()
+        # start from an empty archive so removed sources do not linger in it
+        if os.path.exists(archive):
+            os.remove(archive)
+        with self.tracer.span("archive %s" % os.path.basename(archive), "archive", app=app_name):
+            result = self.executor.run([self.archiver, "rcs", archive, *objects])
+        execution_time.end()
+        if result.returncode != 0:
+            raise CompileError("Error in archiving app %s\n%s" %
+                               (style_warning(app_name), result.output))
+        manifest.record_archive(archive, objects)
+        self.stdout.write("[ %s ] --- %s --- [ %s ]" % (
+            style_success("archive"), style_warning(app_name), style_warning(archive)),
+            ending=f" {execution_time.get_execution_time()}\n")
+        return archive
+
+    def get_shared_name(self, app_name):
+        return "lib%s.so" % app_name
+
+    def _link_shared_app(self, app_name, app_dir, objects, dependencies, manifest):
+        """
+        Link the ``objects`` of an app into ``build/<profile>/<app>/lib<app>.so``
+        (``app_dir``) against the shared libraries of its ``dependencies``. It
+        is only linked again when one of its objects or the link flags changed,
+        not when another app did. Return the library path.
+        """
+        objects = sorted(objects)
+        library = os.path.join(app_dir, self.get_shared_name(app_name))
+        compiler = compiler_identity(self.compiler)
+        fingerprint = self.get_link_fingerprint("", dependencies)
+        if not manifest.link_is_stale(library, objects, compiler, fingerprint):
+            return library
+        execution_time = ExecutionTime()
+        execution_time.start()
+        argv = [self.compiler, "-shared", "-o", library, *objects,
+                *self.get_link_args(dependencies, library), *self.get_compile_flags(), *self.link_flags]
+        with self.tracer.span("link %s" % os.path.basename(library), "link", app=app_name,
+                              linker=self.get_linker_name()):
+            result = self.executor.run(argv)
+        execution_time.end()
+        if result.returncode != 0:
+            raise CompileError("Error in linking app %s\n%s\n%s" % (
+                style_warning(app_name), style_error(format_command(argv)), result.output))
+        manifest.record_link(library, objects, compiler, fingerprint)
+        self.stdout.write("[ %s ] --- %s --- [ %s ]" % (
+            style_success("link"), style_warning(app_name), style_warning(library)),
+            ending=f" {execution_time.get_execution_time()}\n")
+        return library
+
+    def get_link_args(self, archives, output=None):
+        """
+        Return the linker arguments of the app ``archives``, given in link
+        order. With GNU-style linkers they are also grouped so apps that do
+        not declare their ``depends_on`` may still reference each other; the
+        macOS linker has no groups and needs none, it searches every archive
+        for every undefined symbol. Shared apps are found at runtime relative
+        to the ``output`` linked with them.
+        """
+        if not archives:
+            return []
+        darwin = sys.platform == "darwin"
+        libraries = []
+        for archive in archives:
+            libraries += ["-L%s" % os.path.dirname(archive), "-l%s" % app_name_of(archive)]
+        if self.shared and output is not None:
+            output_dir = os.path.dirname(os.path.abspath(output))
+            libraries += ["-Wl,-rpath,%s/%s" % ("@loader_path" if darwin else "$ORIGIN",
+                                                os.path.relpath(os.path.dirname(archive), output_dir))
+                          for archive in archives]
+            if darwin:
+                return libraries
+            # load every app, even those the output does not reference directly
+            return ["-Wl,--no-as-needed", *libraries]
+        if darwin:
+            return libraries
+        return ["-Wl,--start-group", *libraries, "-Wl,--end-group"]
+
+    def _report_cache(self, cache):
+        stats = cache.build_stats()
+        if stats["hits"]:
+            self.stdout.write("[ %s ] --- %s objects restored (%s)" % (
+                style_success("cached"), stats["hits"],
+                ", ".join("%s %s" % (method, stats[method]) for method in RESTORE_METHODS)))
+
+    def get_compile_flags(self):
+        """Return the flags every translation unit is compiled with: those of the profile."""
+        return self.profile_flags["flags"] + (["-fPIC"] if self.shared else [])
+
+    def get_link_fingerprint(self, commands, libraries=()):
+        """
+        Return what, besides its inputs, decides whether an executable or a
+        shared app is linked again: the flags, and the names of the shared
+        ``libraries`` it is linked with.
+        """
+        names = [os.path.basename(library) for library in libraries] if self.shared else []
+        return " ".join([*self.get_compile_flags(), *self.link_flags, commands, *names])
+
+    def get_depfile(self, build_dir):
+        """Return the path of the dependency file written next to an object."""
+        return build_dir + ".d"
+
+    def _build_source(self, source_file, build_dir, flags, compiler, fingerprint, cache=None,
+                      extra_headers=()):
+        """
+        Produce the object of one translation unit, from the cache when
+        possible. ``extra_headers`` are dependencies the depfile cannot see,
+        such as the content of a precompiled header. Return (returncode,
+        output, seconds, headers, cached).
+        """
+        if cache is not None:
+            execution_time = ExecutionTime()
+            execution_time.start()
+            with self.tracer.span("cache %s" % os.path.basename(source_file), "cache",
+                                  source=source_file) as span:
+                headers = cache.fetch(source_file, build_dir, compiler, fingerprint)
+                span["args"] = dict(span.get("args", {}), hit=headers is not None)
+            execution_time.end()
+            if headers is not None:
+                return 0, "", execution_time.end_time - execution_time.start_time, headers, True
+        returncode, output, seconds = self._compile_source(source_file, build_dir, flags)
+        headers = []
+        if returncode == 0:
+            headers = parse_depfile(self.get_depfile(build_dir)) + list(extra_headers)
+            if cache is not None:
+                cache.store(source_file, build_dir, compiler, fingerprint, headers)
+        return returncode, output, seconds, headers, False
+
+    def _compile_source(self, source_file, build_dir, flags=(), language=None):
+        """Compile one translation unit; return (returncode, output, seconds)."""
+        # -MMD -MF lists the user headers the unit includes, for header dependency tracking
+        depfile = ["-MMD", "-MF", self.get_depfile(build_dir)]
+        # the previous object may be a link into the object cache: never write through it
+        for path in [build_dir, *(os.path.splitext(build_dir)[0] + suffix
+                                  for suffix in COMPANION_SUFFIXES)]:
+            if os.path.lexists(path):
+                os.remove(path)
+        source = ["-x", language, source_file] if language else [source_file]
+        # -ftime-trace does not change the object, it stays out of the fingerprint
+        time_trace = ["-ftime-trace"] if self.time_trace else []
+        # debug info names the working directory, remapped to ".", and the .dwo
+        # by the -o path given: with both relative, every checkout of the
+        # project compiles the same object (the cache keys its relative path)
+        prefix_map = ["-fdebug-prefix-map=%s=." % os.getcwd()]
+        with self.tracer.span("compile %s" % os.path.basename(source_file), "compile",
+                              source=source_file, object=build_dir) as span:
+            result = self.executor.run([self.compiler, "-c", *source, "-o", os.path.relpath(build_dir),
+                                        *depfile, *flags, *prefix_map, *time_trace])
+        if self.time_trace:
+            self.tracer.merge_time_trace(os.path.splitext(build_dir)[0] + ".json", span)
+        return result.returncode, result.output, result.seconds
 
     def validate(self, directory, cpp_file=None):
         if cpp_file is None:
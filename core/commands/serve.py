@@ -0,0 +1,36 @@
+import os
+from cpm.core.base import BaseCommand, CommandError
+from cpm.core.color import colorize, style_success, style_warning
+from cpm.core import server
+
+
+class Command(BaseCommand):
+    help = "Keep the {project} loaded and build it for the cpm command line".format(
+        project=colorize("project", fg="blue", opts=("bold",)))
+    description = "Runs a build daemon."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stop', dest='stop', action='store_true',
+                            help='Stop the daemon of the project.')
+        parser.add_argument('--status', dest='status', action='store_true',
+                            help='Show whether a daemon serves the project.')
+
+    def handle(self, **options):
+        project_dir = os.getcwd()
+        if not hasattr(server.socket, "AF_UNIX"):
+            raise CommandError("cpm serve needs Unix domain sockets")
+        if options["stop"]:
+            if server.stop(project_dir):
+                self.stdout.write("[ %s ] --- daemon stopped" % style_success("serve"))
+            else:
+                self.stdout.write("[ %s ] --- no daemon is running" % style_warning("serve"))
+        elif options["status"]:
+            status = server.status(project_dir)
+            if status is None:
+                self.stdout.write("[ %s ] --- no daemon is running" % style_warning("serve"))
+            else:
+                self.stdout.write("[ %s ] --- pid %s, %s sources --- %s" % (
+                    style_success("serve"), status["pid"], status["sources"],
+                    style_warning(status["project"])))
+        else:
+            server.BuildServer(project_dir, self.stdout).serve_forever()
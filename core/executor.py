@@ -0,0 +1,318 @@
+import os
+import sys
+import time
+import shlex
+import shutil
+import signal
+import hashlib
+import tempfile
+import threading
+import subprocess
+from collections import namedtuple
+from cpm.utils.config import default_cache_dir
+
+# Forked from cpm, a program would start with the memory of the Python
+# interpreter in its peak RSS: it is forked from this small program instead,
+# which reports the wait status and resource usage of the program alone.
+MEASURE_SHIM = r"""/* cpm-measure FD LIMIT PROGRAM [ARGUMENT...]
+ *
+ * Run PROGRAM with its address space capped at LIMIT bytes (0: no cap) and
+ * write its wait status, wall time, user and system CPU time and peak RSS to
+ * the file descriptor FD.
+ */
+#include <errno.h>
+#include <fcntl.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+#include <sys/resource.h>
+#include <sys/time.h>
+#include <sys/wait.h>
+
+int main(int argc, char **argv)
+{
+    struct timespec start, end;
+    struct rusage usage;
+    struct rlimit limit;
+    int fd, status;
+    pid_t pid;
+    FILE *report;
+
+    if (argc < 4)
+        return 127;
+    fd = atoi(argv[1]);
+    limit.rlim_cur = limit.rlim_max = (rlim_t) strtoull(argv[2], NULL, 10);
+    /* the program must not hold the report open */
+    fcntl(fd, F_SETFD, FD_CLOEXEC);
+    clock_gettime(CLOCK_MONOTONIC, &start);
+    pid = fork();
+    if (pid < 0) {
+        perror("fork");
+        return 127;
+    }
+    if (pid == 0) {
+        if (limit.rlim_max != 0 && setrlimit(RLIMIT_AS, &limit) != 0) {
+            perror("setrlimit");
+            _exit(127);
+        }
+        execvp(argv[3], argv + 3);
+        fprintf(stderr, "%s: %s\n", argv[3], strerror(errno));
+        _exit(127);
+    }
+    while (wait4(pid, &status, 0, &usage) < 0) {
+        if (errno != EINTR) {
+            perror("wait4");
+            return 127;
+        }
+    }
+    clock_gettime(CLOCK_MONOTONIC, &end);
+    report = fdopen(fd, "w");
+    if (report != NULL) {
+        fprintf(report, "%d %.9f %ld.%06ld %ld.%06ld %ld\n", status,
+                (double) (end.tv_sec - start.tv_sec) + (end.tv_nsec - start.tv_nsec) / 1e9,
+                (long) usage.ru_utime.tv_sec, (long) usage.ru_utime.tv_usec,
+                (long) usage.ru_stime.tv_sec, (long) usage.ru_stime.tv_usec, (long) usage.ru_maxrss);
+        fclose(report);
+    }
+    return WIFEXITED(status) ? WEXITSTATUS(status) : 128 + WTERMSIG(status);
+}
+"""
+MEASURE_SHIM_COMPILERS = ("cc", "gcc", "clang")
+_measure_shim_lock = threading.Lock()
+_measure_shim = {}
+
+
+def format_command(argv):
+    """Return an argument vector as a shell-quoted command line, for messages."""
+    return " ".join(shlex.quote(str(arg)) for arg in argv)
+
+
+class JobResult(namedtuple("JobResult", "argv returncode stdout stderr seconds")):
+    """Outcome of one job; ``returncode`` is None for a cancelled job."""
+
+    @property
+    def cancelled(self):
+        return self.returncode is None
+
+    @property
+    def output(self):
+        """stdout and stderr of the job, without surrounding blank lines."""
+        return "\n".join(part.strip("\n") for part in (self.stdout, self.stderr) if part.strip())
+
+
+class Measurement(namedtuple("Measurement",
+                              "argv returncode seconds user system max_rss stderr timed_out")):
+    """
+    Resources used by one run of a program: wall, user and system CPU time
+    in seconds and peak resident memory in bytes. ``returncode`` is None
+    for a cancelled run and negative for a run killed by a signal, such as
+    one that ran out of time. ``max_rss`` is None when it could not be
+    measured.
+    """
+
+    @property
+    def cancelled(self):
+        return self.returncode is None
+
+
+def get_measure_shim():
+    """
+    Return the path of the ``MEASURE_SHIM`` program, compiled into the cpm
+    cache directory on first use, or None when no C compiler can build it.
+    """
+    with _measure_shim_lock:
+        if "path" not in _measure_shim:
+            _measure_shim["path"] = _build_measure_shim()
+        return _measure_shim["path"]
+
+
+def _build_measure_shim():
+    for compiler in MEASURE_SHIM_COMPILERS:
+        if shutil.which(compiler) is None:
+            continue
+        tools_dir = os.path.join(default_cache_dir(), "tools")
+        path = os.path.join(tools_dir, "cpm-measure-%s" % hashlib.sha1(
+            (compiler + MEASURE_SHIM).encode()).hexdigest()[:12])
+        if os.path.exists(path):
+            return path
+        try:
+            os.makedirs(tools_dir, exist_ok=True)
+            with tempfile.TemporaryDirectory(dir=tools_dir) as build_dir:
+                source = os.path.join(build_dir, "measure.c")
+                with open(source, "w") as f:
+                    f.write(MEASURE_SHIM)
+                result = subprocess.run([compiler, "-O2", "-o", os.path.join(build_dir, "measure"), source],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                if result.returncode != 0:
+                    continue
+                os.replace(os.path.join(build_dir, "measure"), path)
+            return path
+        except OSError:
+            continue
+    return None
+
+
+def exit_code(status):
+    """Return the return code of a wait status, like ``Popen.returncode``."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class Executor:
+    """
+    Run build steps as subprocesses from argument vectors, without a shell.
+
+    Any number of threads may call ``run()``: at most ``jobs`` processes run
+    at once and the others wait for a free slot. The stdout and stderr of
+    each job are captured in separate buffers. ``cancel()`` kills the
+    running processes and makes every job not started yet return at once, so
+    a build stops at its first failure.
+    """
+
+    def __init__(self, jobs=1):
+        self.jobs = jobs
+        self._slots = threading.BoundedSemaphore(jobs)
+        self._lock = threading.Lock()
+        self._processes = set()
+        # measured processes lead a process group: the shim and the program
+        self._groups = set()
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def run(self, argv, cwd=None, capture=True, **kwargs):
+        """
+        Run ``argv`` and return its JobResult. With ``capture=False`` the job
+        shares the terminal (e.g. the program being run) and its output is
+        not recorded.
+        """
+        argv = [str(arg) for arg in argv]
+        pipe = subprocess.PIPE if capture else None
+        with self._slots:
+            if self.cancelled:
+                return JobResult(argv, None, "", "", 0.0)
+            start = time.perf_counter()
+            try:
+                process = subprocess.Popen(argv, cwd=cwd, stdout=pipe, stderr=pipe,
+                                           universal_newlines=True, **kwargs)
+            except OSError as e:
+                return JobResult(argv, 127, "", "%s: %s" % (argv[0], e.strerror), 0.0)
+            with self._lock:
+                self._processes.add(process)
+                if self.cancelled:
+                    process.kill()
+            try:
+                stdout, stderr = process.communicate()
+            finally:
+                with self._lock:
+                    self._processes.discard(process)
+            seconds = time.perf_counter() - start
+        if self.cancelled and process.returncode != 0:
+            return JobResult(argv, None, stdout or "", stderr or "", seconds)
+        return JobResult(argv, process.returncode, stdout or "", stderr or "", seconds)
+
+    def measure(self, argv, cwd=None, stdin=None, stdout=subprocess.DEVNULL, timeout=None,
+                memory_limit=None, **kwargs):
+        """
+        Run ``argv`` and return its Measurement (Unix only). The program is
+        started by the ``MEASURE_SHIM``, which reports its resource usage;
+        without the shim the usage is read from ``os.wait4`` and the peak
+        memory is unknown, as it would count the memory of cpm itself. The
+        output of the program goes to ``stdout``, discarded by default; its
+        stderr is kept for messages. The program is killed after ``timeout``
+        seconds, and its address space is capped at ``memory_limit`` bytes.
+        """
+        argv = [str(arg) for arg in argv]
+        shim = get_measure_shim()
+        report_fd = None
+        with self._slots, tempfile.TemporaryFile("w+") as stderr:
+            if self.cancelled:
+                return Measurement(argv, None, 0.0, 0.0, 0.0, None, "", False)
+            # the cap is set between fork and exec by the shim or the shell, never
+            # by Python code in the child: a preexec_fn is unsafe with threads
+            command = argv
+            if shim is not None:
+                report_fd, write_fd = os.pipe()
+                command = [shim, str(write_fd), str(memory_limit or 0), *argv]
+                kwargs["pass_fds"] = (write_fd,)
+            elif memory_limit is not None:
+                command = ["/bin/sh", "-c", 'ulimit -v %d && exec "$@"' % max(memory_limit // 1024, 1),
+                           "sh", *argv]
+            start = time.perf_counter()
+            try:
+                # in a session of its own: the shim and the program are killed together
+                process = subprocess.Popen(command, cwd=cwd, stdin=stdin, stdout=stdout, stderr=stderr,
+                                           start_new_session=True, **kwargs)
+            except OSError as e:
+                if report_fd is not None:
+                    os.close(report_fd)
+                return Measurement(argv, 127, 0.0, 0.0, 0.0, None, "%s: %s" % (argv[0], e.strerror),
+                                   False)
+            finally:
+                if report_fd is not None:
+                    os.close(write_fd)
+            expired = threading.Event()
+            with self._lock:
+                self._processes.add(process)
+                self._groups.add(process)
+                if self.cancelled:
+                    self._kill(process)
+            timer = None
+            if timeout is not None:
+                timer = threading.Timer(timeout, self._expire, (process, expired))
+                timer.start()
+            try:
+                # stderr goes to a file: a pipe could fill up while nobody reads it
+                _, status, usage = os.wait4(process.pid, 0)
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                with self._lock:
+                    self._processes.discard(process)
+                    self._groups.discard(process)
+            seconds = time.perf_counter() - start
+            # reaped by wait4: Popen must not wait for it again
+            process.returncode = exit_code(status)
+            stderr.seek(0)
+            errors = stderr.read()
+        user, system, max_rss = usage.ru_utime, usage.ru_stime, None
+        if report_fd is not None:
+            with os.fdopen(report_fd, "rb") as f:
+                report = f.read().split()
+            if len(report) == 5:
+                # the program ran to its end (or was killed by another signal)
+                status = int(report[0])
+                process.returncode = exit_code(status)
+                seconds, user, system = float(report[1]), float(report[2]), float(report[3])
+                # ru_maxrss is in kilobytes, except on macOS
+                max_rss = int(report[4]) * (1 if sys.platform == "darwin" else 1024)
+        returncode = None if self.cancelled and process.returncode != 0 else process.returncode
+        return Measurement(argv, returncode, seconds, user, system, max_rss, errors, expired.is_set())
+
+    def _kill(self, process):
+        """Kill ``process``, with its whole process group when it was measured."""
+        if process in self._groups:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+        elif process.poll() is None:
+            process.kill()
+
+    def _expire(self, process, expired):
+        with self._lock:
+            if process in self._processes:
+                expired.set()
+                self._kill(process)
+
+    def cancel(self):
+        """Kill every running job and refuse to start new ones."""
+        self._cancelled.set()
+        with self._lock:
+            for process in self._processes:
+                self._kill(process)
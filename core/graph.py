@@ -0,0 +1,74 @@
+from cpm.core.color import style_error
+from cpm.utils.exceptions import AppNotFoundError, DependencyCycleError
+
+
+class AppGraph:
+    """
+    Dependency graph of the apps of a project, from the ``depends_on`` list
+    of each app in cpm.json.
+    """
+
+    def __init__(self, apps):
+        self.apps = [app["name"] for app in apps]
+        self.depends_on = {app["name"]: list(app.get("depends_on", [])) for app in apps}
+        for name, dependencies in self.depends_on.items():
+            for dependency in dependencies:
+                if dependency not in self.depends_on:
+                    raise AppNotFoundError("%s depends on %s which is not an app of cpm.json" % (
+                        style_error(name), style_error(dependency)))
+        self.order = self._topological_order()
+
+    def _topological_order(self):
+        order, state = [], {}
+        for name in self.apps:
+            stack = [(name, iter(self.depends_on[name]))]
+            if state.get(name) == "done":
+                continue
+            state[name] = "visiting"
+            while stack:
+                node, dependencies = stack[-1]
+                for dependency in dependencies:
+                    if state.get(dependency) == "visiting":
+                        cycle = [entry[0] for entry in stack]
+                        cycle = cycle[cycle.index(dependency):] + [dependency]
+                        raise DependencyCycleError("dependency cycle between apps: %s" %
+                                                   style_error(" -> ".join(cycle)))
+                    if state.get(dependency) is None:
+                        state[dependency] = "visiting"
+                        stack.append((dependency, iter(self.depends_on[dependency])))
+                        break
+                else:
+                    stack.pop()
+                    state[node] = "done"
+                    order.append(node)
+        return order
+
+    def has_dependencies(self):
+        return any(self.depends_on.values())
+
+    def dependencies(self, name):
+        """Return every app ``name`` depends on, directly or transitively."""
+        seen, stack = [], list(self.depends_on[name])
+        while stack:
+            dependency = stack.pop()
+            if dependency not in seen:
+                seen.append(dependency)
+                stack.extend(self.depends_on[dependency])
+        return [app for app in self.order if app in seen]
+
+    def link_order(self, names):
+        """Order ``names`` for a static link: every app before its dependencies."""
+        return [app for app in reversed(self.order) if app in names]
+
+    def critical_path(self, durations):
+        """
+        Return ``(seconds, path)`` of the longest chain of dependent apps,
+        weighting each app by its build duration.
+        """
+        longest = {}
+        for name in self.order:
+            seconds = durations.get(name, 0.0)
+            previous = max((longest[dependency] for dependency in self.depends_on[name]),
+                           default=(0.0, []), key=lambda item: item[0])
+            longest[name] = (previous[0] + seconds, previous[1] + [name])
+        return max(longest.values(), default=(0.0, []), key=lambda item: item[0])
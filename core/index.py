@@ -0,0 +1,86 @@
+import os
+import json
+import time
+from json import JSONDecodeError
+
+# a directory listed less than this long after its last change may change
+# again within the same mtime tick: it is listed again next time
+RACY_NS = 2 * 10 ** 9
+
+
+class SourceIndex:
+    """
+    Persistent index of the files of the source directories of a project.
+
+    Every directory is recorded with its mtime and its entries. Adding,
+    removing or renaming an entry changes the mtime of its directory, so a
+    directory whose mtime did not change is not listed again: finding the
+    sources of an unchanged tree costs one ``stat`` per directory. Without a
+    ``build_dir`` the index lives in memory only.
+    """
+    file_name = ".cpm-sources.json"
+    version = 1
+
+    def __init__(self, build_dir=None):
+        self.path = os.path.join(build_dir, self.file_name) if build_dir else None
+        self.dirs = {}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, JSONDecodeError):
+            return
+        if data.get("version") == self.version:
+            self.dirs = data.get("dirs", {})
+
+    def save(self):
+        if self.path is None or not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.version, "dirs": self.dirs}, f)
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+    def _list(self, directory):
+        st = os.stat(directory)
+        entry = self.dirs.get(directory)
+        if (entry is not None and entry["mtime"] == st.st_mtime_ns
+                and entry["scanned"] - st.st_mtime_ns > RACY_NS):
+            return entry
+        files, dirs = [], []
+        with os.scandir(directory) as entries:
+            for item in entries:
+                # like os.walk: symlinks to directories are not followed
+                if item.is_dir(follow_symlinks=False):
+                    dirs.append(item.name)
+                else:
+                    files.append(item.name)
+        entry = self.dirs[directory] = {"mtime": st.st_mtime_ns, "scanned": time.time_ns(),
+                                        "files": sorted(files), "dirs": sorted(dirs)}
+        self.changed = True
+        return entry
+
+    def files(self, root, suffixes):
+        """Return the files under ``root`` whose name ends with one of ``suffixes``."""
+        found, visited = [], set()
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            visited.add(directory)
+            entry = self._list(directory)
+            found.extend(os.path.join(directory, name) for name in entry["files"]
+                         if name.endswith(suffixes))
+            stack.extend(os.path.join(directory, name) for name in reversed(entry["dirs"]))
+        # forget directories of this tree that were removed
+        for directory in list(self.dirs):
+            if directory not in visited and (directory + os.sep).startswith(root + os.sep):
+                del self.dirs[directory]
+                self.changed = True
+        return found
@@ -0,0 +1,218 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+from json import JSONDecodeError
+
+# a prerequisite of a depfile: GCC only escapes a space or '#' with a
+# backslash and '$' as '$$'; any other backslash (Windows paths) is literal
+DEPFILE_WORD = re.compile(r"(?:\\[ #]|\$\$|\S)+")
+DEPFILE_ESCAPE = re.compile(r"\\([ #])|\$(\$)")
+
+
+def file_digest(path, chunk_size=1 << 16):
+    """Return the sha1 hex digest of the content of ``path``."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compiler_identity(compiler):
+    """
+    Identify a compiler without running it: the resolved executable path
+    together with its size and mtime changes whenever the toolchain does.
+    """
+    path = shutil.which(compiler)
+    if path is None:
+        return compiler
+    st = os.stat(path)
+    return "%s:%s:%s" % (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+
+def parse_depfile(path):
+    """
+    Parse a make-style dependency file written by ``g++ -MMD -MF`` and
+    return the prerequisites of its first target.
+    """
+    with open(path) as f:
+        content = f.read().replace("\\\n", " ")
+    _, _, prerequisites = content.partition(": ")
+    return [DEPFILE_ESCAPE.sub(lambda match: match.group(1) or match.group(2), word)
+            for word in DEPFILE_WORD.findall(prerequisites.split("\n\n")[0])]
+
+
+class BuildManifest:
+    """
+    Persistent record of what produced every object file under ``build/``.
+
+    Each compiled source is stored with its mtime/size, content hash, the
+    compiler identity and the flags it was compiled with, plus the headers it
+    includes (read from the compiler's depfile). An object is only rebuilt
+    when one of these changed or when the object itself is missing.
+
+    Static archives are recorded with the size and mtime of their members, so
+    an archive is only rewritten when one of its members changed. Executables
+    are recorded with the state of every link input (entry point, the headers
+    it includes, archives) and the link flags, so an unchanged executable is
+    not linked again.
+    """
+    file_name = ".cpm-manifest.json"
+    version = 2
+
+    def __init__(self, build_dir):
+        self.path = os.path.join(build_dir, self.file_name)
+        self.entries = {}
+        self.archives = {}
+        self.links = {}
+        # header path -> changed flag and current state, once checked during this build
+        self.reset()
+        self.load()
+
+    def reset(self):
+        """Forget what was checked during the last build, before the next one."""
+        self._header_changed = {}
+        self._header_state = {}
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, JSONDecodeError):
+            return
+        if data.get("version") == self.version:
+            self.entries = data.get("sources", {})
+            self.archives = data.get("archives", {})
+            self.links = data.get("links", {})
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.version, "sources": self.entries,
+                       "archives": self.archives, "links": self.links}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def is_stale(self, source_file, object_file, compiler, flags):
+        """Return True if ``source_file`` must be compiled again."""
+        entry = self.entries.get(source_file)
+        if entry is None or not os.path.exists(object_file):
+            return True
+        if (entry["object"] != object_file or entry["compiler"] != compiler
+                or entry["flags"] != flags):
+            return True
+        if self._changed(source_file, entry):
+            return True
+        return any(self._header_is_changed(header, state)
+                   for header, state in entry["headers"].items())
+
+    def _changed(self, path, state):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return True
+        if state["mtime"] == st.st_mtime_ns and state["size"] == st.st_size:
+            return False
+        # touched but maybe not modified: fall back to the content hash
+        if state["hash"] != file_digest(path):
+            return True
+        state["mtime"], state["size"] = st.st_mtime_ns, st.st_size
+        return False
+
+    def _header_is_changed(self, header, state):
+        # headers are shared by many sources, check each one once per build
+        if header not in self._header_changed:
+            self._header_changed[header] = self._changed(header, state)
+            if not self._header_changed[header]:
+                self._header_state[header] = state
+        return self._header_changed[header]
+
+    def _file_state(self, path):
+        st = os.stat(path)
+        return {"mtime": st.st_mtime_ns, "size": st.st_size, "hash": file_digest(path)}
+
+    def record(self, source_file, object_file, compiler, flags, headers=(), compile_time=None):
+        """
+        Remember how ``object_file`` was produced. ``headers`` are the
+        headers the source includes, directly or transitively.
+        ``compile_time`` is a ``(variant, seconds)`` pair kept per variant
+        (e.g. with and without a precompiled header) across builds.
+        """
+        times = self.entries.get(source_file, {}).get("times", {})
+        if compile_time is not None:
+            variant, seconds = compile_time
+            times = dict(times, **{variant: seconds})
+        entry = self._file_state(source_file)
+        entry.update({
+            "object": object_file,
+            "compiler": compiler,
+            "flags": flags,
+            "headers": {},
+            "times": times,
+        })
+        for header in headers:
+            header = os.path.abspath(header)
+            if header == source_file or not os.path.exists(header):
+                continue
+            if header not in self._header_state:
+                self._header_state[header] = self._file_state(header)
+            entry["headers"][header] = self._header_state[header]
+        self.entries[source_file] = entry
+
+    def _members_state(self, members):
+        state = {}
+        for member in members:
+            st = os.stat(member)
+            state[member] = [st.st_mtime_ns, st.st_size]
+        return state
+
+    def archive_is_stale(self, archive, members):
+        """Return True if ``archive`` must be rewritten from ``members``."""
+        if not os.path.exists(archive):
+            return True
+        return self.archives.get(archive) != self._members_state(members)
+
+    def record_archive(self, archive, members):
+        self.archives[archive] = self._members_state(members)
+
+    def link_is_stale(self, executable, inputs, compiler, flags):
+        """Return True if ``executable`` must be linked again from ``inputs``."""
+        entry = self.links.get(executable)
+        if entry is None or not os.path.exists(executable):
+            return True
+        if (entry["inputs"] != list(inputs) or entry["compiler"] != compiler
+                or entry["flags"] != flags):
+            return True
+        return any(self._changed(path, state) for path, state in entry["files"].items())
+
+    def record_link(self, executable, inputs, compiler, flags, headers=()):
+        files = {}
+        for path in [*inputs, *headers]:
+            path = os.path.abspath(path)
+            if path not in files and os.path.exists(path):
+                files[path] = self._file_state(path)
+        self.links[executable] = {
+            "inputs": list(inputs),
+            "compiler": compiler,
+            "flags": flags,
+            "files": files,
+        }
+
+    def dependents(self, path):
+        """Return the sources that include ``path``, directly or transitively."""
+        path = os.path.abspath(path)
+        return [source_file for source_file, entry in self.entries.items()
+                if source_file == path or path in entry["headers"]]
+
+    def prune(self, source_files):
+        """Forget sources that are no longer part of the build."""
+        for source_file in set(self.entries) - set(source_files):
+            # precompiled headers are tracked like sources, but not listed in them
+            if not self.entries[source_file]["object"].endswith(".gch"):
+                del self.entries[source_file]
+        objects = {entry["object"] for entry in self.entries.values()}
+        for archive in list(self.archives):
+            if not set(self.archives[archive]) <= objects:
+                del self.archives[archive]
@@ -0,0 +1,94 @@
+import os
+import hashlib
+
+
+def escape_path(path):
+    """Escape a path for the left or right side of a ninja build statement."""
+    return path.replace("$", "$$").replace(" ", "$ ").replace(":", "$:")
+
+
+def escape(value):
+    """Escape a variable value."""
+    return value.replace("$", "$$")
+
+
+class NinjaWriter:
+    """
+    Minimal writer of ninja build files (rules, build statements and
+    variables), after ninja's own ``ninja_syntax`` module.
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def comment(self, text):
+        self.lines.append("# %s" % text)
+
+    def newline(self):
+        self.lines.append("")
+
+    def variable(self, key, value, indent=0):
+        if isinstance(value, (list, tuple)):
+            value = " ".join(item for item in value if item)
+        self.lines.append("%s%s = %s" % ("  " * indent, key, value))
+
+    def rule(self, name, command, description=None, depfile=None, deps=None, restat=False):
+        self.lines.append("rule %s" % name)
+        self.variable("command", command, indent=1)
+        if description:
+            self.variable("description", description, indent=1)
+        if depfile:
+            self.variable("depfile", depfile, indent=1)
+        if deps:
+            self.variable("deps", deps, indent=1)
+        if restat:
+            self.variable("restat", "1", indent=1)
+        self.newline()
+
+    def build(self, outputs, rule, inputs=(), implicit=(), order_only=(), variables=None):
+        line = "build %s: %s" % (" ".join(map(escape_path, outputs)), rule)
+        if inputs:
+            line += " " + " ".join(map(escape_path, inputs))
+        if implicit:
+            line += " | " + " ".join(map(escape_path, implicit))
+        if order_only:
+            line += " || " + " ".join(map(escape_path, order_only))
+        self.lines.append(line)
+        for key, value in (variables or {}).items():
+            self.variable(key, value, indent=1)
+        self.newline()
+
+    def default(self, targets):
+        self.lines.append("default %s" % " ".join(map(escape_path, targets)))
+
+    def getvalue(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def stamp_of(*parts):
+    """Return the stamp identifying the inputs a build file was generated from."""
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(str(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def write_if_changed(path, stamp, generate):
+    """
+    Write the build file returned by ``generate()`` to ``path`` unless the
+    existing file was generated from the same ``stamp``. Return True if the
+    file was written.
+    """
+    header = "# cpm-stamp: %s\n" % stamp
+    try:
+        with open(path) as f:
+            if f.readline() == header:
+                return False
+    except FileNotFoundError:
+        pass
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(header + generate())
+    os.replace(tmp_path, path)
+    return True
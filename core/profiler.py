@@ -0,0 +1,70 @@
+import re
+import shutil
+
+# supported profilers, preferred first
+PROFILERS = ("perf", "gprof")
+
+GPROF_FLAT_ROW = re.compile(
+    r"^\s*(?P<percent>[\d.]+)\s+[\d.]+\s+(?P<self>[\d.]+)\s+"
+    r"(?:(?P<calls>\d+)\s+[\d.]+\s+[\d.]+\s+)?(?P<name>\S.*?)\s*$")
+GPROF_CALL_GRAPH_ROW = re.compile(
+    r"^\[\d+\]\s+(?P<percent>[\d.]+)\s+(?P<self>[\d.]+)\s+(?P<children>[\d.]+)\s+"
+    r"(?:(?P<calls>\d+(?:[+/]\d+)*)\s+)?(?P<name>\S.*?)\s+\[\d+\]\s*$")
+PERF_ROW = re.compile(
+    r"^\s*(?P<children>[\d.]+)%\s+(?P<self>[\d.]+)%\s+\[[.k]\]\s+(?P<name>\S.*?)\s*$")
+
+
+def get_profiler(name="auto"):
+    """
+    Return the profiler ``name`` ("auto" for the first of ``PROFILERS``
+    installed), or None when it is not installed.
+    """
+    for profiler in PROFILERS if name == "auto" else (name,):
+        if shutil.which(profiler) is not None:
+            return profiler
+    return None
+
+
+def parse_gprof_flat(output):
+    """
+    Parse the flat profile of ``gprof -b -p``; return ``(percent, self_seconds,
+    calls, function)`` rows, most expensive first. ``calls`` is None for
+    functions compiled without ``-pg``.
+    """
+    rows = []
+    for line in output.splitlines():
+        match = GPROF_FLAT_ROW.match(line)
+        if match is not None:
+            calls = match.group("calls")
+            rows.append((float(match.group("percent")), float(match.group("self")),
+                         int(calls) if calls else None, match.group("name")))
+    return rows
+
+
+def parse_gprof_call_graph(output):
+    """
+    Parse the call graph of ``gprof -b -q``; return the ``(percent,
+    self_seconds, children_seconds, function)`` of every function, the
+    percent counting the time spent in the function and its callees.
+    """
+    rows = []
+    for line in output.splitlines():
+        match = GPROF_CALL_GRAPH_ROW.match(line)
+        if match is not None:
+            rows.append((float(match.group("percent")), float(match.group("self")),
+                         float(match.group("children")), match.group("name")))
+    return sorted(rows, key=lambda row: -row[0])
+
+
+def parse_perf_report(output):
+    """
+    Parse ``perf report --stdio --children --sort symbol``; return the
+    ``(children_percent, self_percent, symbol)`` rows.
+    """
+    rows = []
+    for line in output.splitlines():
+        match = PERF_ROW.match(line)
+        if match is not None:
+            rows.append((float(match.group("children")), float(match.group("self")),
+                         match.group("name")))
+    return rows
@@ -0,0 +1,256 @@
+import os
+import json
+import stat
+import signal
+import socket
+from io import TextIOBase
+from cpm.core.base import OutputWrapper
+from cpm.core.client import DAEMON_COMMANDS, runtime_dir_path, socket_path, connect, request
+from cpm.core.color import style_error, style_success, style_warning
+from cpm.core.commands import run
+from cpm.core.manifest import BuildManifest
+from cpm.core.watch import get_watcher
+from cpm.utils.exceptions import CommandError
+
+
+class ClientStream(TextIOBase):
+    """Text stream sending everything written to it to a client, as json lines."""
+
+    def __init__(self, f, name):
+        self.f = f
+        self.name = name
+
+    def write(self, text):
+        self.f.write(json.dumps({self.name: text}) + "\n")
+        self.f.flush()
+        return len(text)
+
+    def isatty(self):
+        return True
+
+
+class StopServer(Exception):
+    pass
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+class BuildServer:
+    """
+    Keep a project loaded between builds and build it for the cpm CLI over a
+    Unix socket.
+
+    cpm.json, the source list and the build manifest stay in memory. The project directory is watched (inotify on Linux): cpm.json is
+    parsed again when it changes and the sources of an app are listed again
+    when one is added or removed. As long as nothing changed since the last
+    successful build with the same options, a build request is answered
+    without looking at a single file.
+    """
+    # options the daemon cannot honour: the command is built in process
+    in_process_options = ("watch", "new_terminal", "trace", "profile_program", "inputs")
+
+    def __init__(self, project_dir, stdout):
+        self.project_dir = os.path.realpath(project_dir)
+        self.path = socket_path(self.project_dir)
+        self.stdout = stdout
+        self.builder = run.Command()
+        # one manifest per build profile, like the build directories
+        self.manifests = {}
+        self.watcher = None
+        self.cpm_json = None
+        self.source_files = None
+        self.dirty = True
+        self.last_build = None
+
+    def load(self):
+        """Parse cpm.json and list the sources of every app again."""
+        self.builder.validate(self.project_dir)
+        self.cpm_json = self.builder.load_cpm_config(self.project_dir)
+        self.source_files = self.builder.get_source_files(self.project_dir, self.cpm_json)
+        if self.watcher is not None:
+            self.watcher.close()
+        self.watcher = get_watcher([self.project_dir], ignore=[os.path.join(self.project_dir, "build")])
+
+    def refresh(self):
+        """Apply the filesystem events received since the last request."""
+        changed = set()
+        while True:
+            events = self.watcher.poll(0)
+            if not events:
+                break
+            changed |= events
+        if not changed:
+            return
+        self.dirty = True
+        if os.path.join(self.project_dir, "cpm.json") in changed:
+            self.cpm_json = None
+            return
+        apps = {app["name"]: app for app in self.builder.get_app(self.cpm_json) or ()}
+        rescan = set()
+        for path in changed:
+            app_name = os.path.relpath(path, self.project_dir).split(os.sep)[0]
+            if app_name == os.curdir:
+                # the watcher overflowed and dropped events: anything, cpm.json
+                # included, may have changed
+                self.cpm_json = None
+                return
+            if app_name in apps and self.builder.changes_sources(path, self.source_files):
+                rescan.add(app_name)
+        try:
+            for app_name in rescan:
+                self.source_files = {source_file: name
+                                     for source_file, name in self.source_files.items()
+                                     if name != app_name}
+                self.source_files.update(self.builder.get_app_files(self.project_dir, apps[app_name]))
+        except BaseException:
+            # the source list is incomplete: load everything again next time
+            self.cpm_json = None
+            raise
+
+    def build(self, argv, stdout, stderr):
+        """Build for the command line ``argv``; return the reply to the client."""
+        builder = run.Command(stdout=stdout, stderr=stderr)
+        parser = builder.create_parser("cpm", argv[0])
+        options = vars(parser.parse_args(argv[1:]))
+        if any(options.get(option) for option in self.in_process_options):
+            return {"fallback": True}
+        jobs, no_cache, build_options = builder.pop_build_options(options)
+        self.refresh()
+        if self.cpm_json is None:
+            self.load()
+        cpp_file_name = options["cpp_file_name"]
+        if cpp_file_name is None:
+            try:
+                cpp_file_name = self.cpm_json["entry_point"]
+            except KeyError:
+                raise CommandError("Entry point not found in cpm.json file")
+            builder.validate_file_extension(cpp_file_name)
+        builder.validate(self.project_dir, cpp_file_name)
+        profile = builder.get_profile(self.cpm_json, build_options["profile"])[0]
+        exe_name = builder.get_executable(cpp_file_name, profile)
+        key = [cpp_file_name, no_cache, profile, build_options]
+        if not self.dirty and key == self.last_build and os.path.exists(exe_name):
+            builder.stdout.write("[ %s ] --- %s (cpm serve)" % (
+                style_success("up-to-date"), style_warning(exe_name)))
+            return {"status": 0, "exe": exe_name}
+        if profile not in self.manifests:
+            self.manifests[profile] = BuildManifest(builder.get_build_dir(self.project_dir, profile))
+        manifest = self.manifests[profile]
+        manifest.reset()
+        self.last_build = None
+        exe_name = builder.build(self.project_dir, cpp_file_name, self.cpm_json, jobs,
+                                 builder.get_cache(self.cpm_json, no_cache), manifest,
+                                 dict(self.source_files), **build_options)
+        self.dirty = False
+        self.last_build = key
+        return {"status": 0, "exe": exe_name}
+
+    def handle_connection(self, conn):
+        with conn, conn.makefile("rw", encoding="utf-8", newline="\n") as f:
+            line = f.readline()
+            if not line:
+                # a client checking whether the daemon is running
+                return
+            message = json.loads(line)
+            stdout, stderr = ClientStream(f, "stdout"), ClientStream(f, "stderr")
+            if message.get("stop"):
+                f.write(json.dumps({"status": 0}) + "\n")
+                raise StopServer
+            if message.get("status"):
+                reply = {"status": 0, "project": self.project_dir, "pid": os.getpid(),
+                         "sources": len(self.source_files or ())}
+            elif message.get("argv", [None])[0] not in DAEMON_COMMANDS:
+                reply = {"fallback": True}
+            elif os.path.realpath(message.get("cwd", "")) != self.project_dir:
+                reply = {"fallback": True}
+            else:
+                try:
+                    reply = self.build(message["argv"], stdout, stderr)
+                except CommandError as e:
+                    OutputWrapper(stderr).write('%s: %s' % (e.__class__.__name__, e))
+                    reply = {"status": getattr(e, "returncode", 1)}
+                except SystemExit:
+                    # --help or --version: argparse prints and exits, let the client do it
+                    reply = {"fallback": True}
+            f.write(json.dumps(reply) + "\n")
+
+    def is_own_socket(self, inode=None):
+        """Return True if the socket path is a socket of this user (bound as ``inode``)."""
+        try:
+            st = os.lstat(self.path)
+        except OSError:
+            return False
+        return (stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid() and
+                (inode is None or st.st_ino == inode))
+
+    def serve_forever(self):
+        if self.path is None:
+            raise CommandError("%s must be a directory of yours that nobody else can access, "
+                               "it holds the daemon sockets" % style_error(runtime_dir_path()))
+        sock = connect(self.project_dir)
+        if sock is not None:
+            sock.close()
+            raise CommandError("a cpm serve daemon is already running for %s" %
+                               style_error(self.project_dir))
+        if os.path.lexists(self.path):
+            # the socket of a daemon that did not exit cleanly
+            if not self.is_own_socket():
+                raise CommandError("%s is in the way of the daemon socket" % style_error(self.path))
+            os.remove(self.path)
+        self.load()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # the socket is private to the user running the daemon
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        inode = os.lstat(self.path).st_ino
+        server.listen(8)
+        signal.signal(signal.SIGTERM, _interrupt)
+        # builds resolve the entry point and the executable from the working directory
+        os.chdir(self.project_dir)
+        self.stdout.write("[ %s ] --- %s --- %s sources, listening on %s" % (
+            style_success("serve"), style_warning(self.project_dir), len(self.source_files),
+            style_warning(self.path)))
+        try:
+            while True:
+                conn, _ = server.accept()
+                try:
+                    self.handle_connection(conn)
+                except StopServer:
+                    raise
+                except Exception as e:
+                    # the client went away, sent garbage or the build crashed: the
+                    # client builds in process, keep serving the others
+                    self.stdout.write("[ %s ] --- %s: %s" % (style_error("error"),
+                                                             e.__class__.__name__, e))
+        except (StopServer, KeyboardInterrupt):
+            pass
+        finally:
+            server.close()
+            # a daemon started after this one was stopped may own the path by now
+            if self.is_own_socket(inode):
+                os.remove(self.path)
+            if self.watcher is not None:
+                self.watcher.close()
+        self.stdout.write("[ %s ] --- stopped" % style_success("serve"))
+
+
+def stop(project_dir):
+    """Ask the daemon of ``project_dir`` to exit; return False if none is running."""
+    sock = connect(project_dir)
+    if sock is None:
+        return False
+    request(sock, {"stop": True})
+    return True
+
+
+def status(project_dir):
+    """Return the status of the daemon of ``project_dir``, or None if none is running."""
+    sock = connect(project_dir)
+    if sock is None:
+        return None
+    return request(sock, {"status": True})
@@ -0,0 +1,67 @@
+import math
+import statistics
+from statistics import NormalDist
+
+
+def t_quantile(p, df):
+    """
+    Return the ``p`` quantile of Student's t distribution with ``df``
+    degrees of freedom, from the normal quantile by the Cornish-Fisher
+    expansion (within 0.5% of the exact value from 3 degrees of freedom).
+    """
+    if df == 1:
+        return math.tan(math.pi * (p - 0.5))
+    if df == 2:
+        return (2 * p - 1) / math.sqrt(2 * p * (1 - p))
+    z = NormalDist().inv_cdf(p)
+    return (z + (z ** 3 + z) / (4 * df)
+            + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2)
+            + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * df ** 3)
+            + (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3 - 945 * z) / (92160 * df ** 4))
+
+
+def summarize(values, confidence=0.95):
+    """
+    Return the mean, median, standard deviation, minimum and maximum of
+    ``values``, with the ``confidence`` interval of the mean.
+    """
+    mean = statistics.mean(values)
+    stdev = statistics.stdev(values) if len(values) > 1 else 0.0
+    if len(values) > 1:
+        margin = t_quantile((1 + confidence) / 2, len(values) - 1) * stdev / math.sqrt(len(values))
+    else:
+        margin = float("inf")
+    return {
+        "mean": mean,
+        "median": statistics.median(values),
+        "stdev": stdev,
+        "min": min(values),
+        "max": max(values),
+        "ci": [mean - margin, mean + margin],
+    }
+
+
+def compare(baseline, candidate, confidence=0.95):
+    """
+    Compare the means of two samples with Welch's t-test, which does not
+    assume equal variances. Return the difference of the means (candidate
+    minus baseline), its ``confidence`` interval, the relative change and
+    whether the difference is significant at that confidence.
+    """
+    mean_a, mean_b = statistics.mean(baseline), statistics.mean(candidate)
+    var_a = statistics.variance(baseline) / len(baseline) if len(baseline) > 1 else 0.0
+    var_b = statistics.variance(candidate) / len(candidate) if len(candidate) > 1 else 0.0
+    difference = mean_b - mean_a
+    error = math.sqrt(var_a + var_b)
+    if error == 0 or len(baseline) < 2 or len(candidate) < 2:
+        margin = 0.0 if error == 0 else float("inf")
+    else:
+        # Welch-Satterthwaite degrees of freedom
+        df = (var_a + var_b) ** 2 / (var_a ** 2 / (len(baseline) - 1) + var_b ** 2 / (len(candidate) - 1))
+        margin = t_quantile((1 + confidence) / 2, df) * error
+    return {
+        "difference": difference,
+        "ci": [difference - margin, difference + margin],
+        "change": difference / mean_a if mean_a else 0.0,
+        "significant": not (difference - margin <= 0 <= difference + margin),
+    }
@@ -0,0 +1,91 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class NullTracer:
+    """Tracer used when no trace is requested: records nothing."""
+    enabled = False
+
+    @contextmanager
+    def span(self, name, category="build", **args):
+        yield {}
+
+    def merge_time_trace(self, path, span):
+        pass
+
+    def save(self):
+        pass
+
+
+class Tracer(NullTracer):
+    """
+    Record the phases of a build as Chrome trace events (``chrome://tracing``,
+    Perfetto or speedscope can open the file).
+
+    Every span is a complete event measured with ``perf_counter_ns``. Spans
+    are laid out in lanes: the main thread is the ``cpm`` lane and each worker
+    thread of the build gets its own ``job`` lane, so a lane shows what one
+    job slot was doing over time.
+    """
+    enabled = True
+    pid = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self._lanes = {}
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter_ns()
+
+    def _lane(self):
+        ident = threading.get_ident()
+        with self._lock:
+            if ident not in self._lanes:
+                lane = self._lanes[ident] = len(self._lanes)
+                name = "cpm" if ident == threading.main_thread().ident else "job %s" % lane
+                self.events.append({"name": "thread_name", "ph": "M", "pid": self.pid,
+                                    "tid": lane, "args": {"name": name}})
+            return self._lanes[ident]
+
+    def _microseconds(self, ns):
+        return (ns - self._origin) / 1000.0
+
+    @contextmanager
+    def span(self, name, category="build", **args):
+        """Record the time spent in the ``with`` block as one event."""
+        event = {"name": name, "cat": category, "ph": "X", "pid": self.pid, "tid": self._lane(),
+                 "args": args}
+        start = time.perf_counter_ns()
+        try:
+            yield event
+        finally:
+            event["ts"] = self._microseconds(start)
+            event["dur"] = (time.perf_counter_ns() - start) / 1000.0
+            self.events.append(event)
+
+    def merge_time_trace(self, path, span):
+        """
+        Merge the ``-ftime-trace`` file of a compile into its ``span``: the
+        compiler's own events (parsing of each header, template
+        instantiations, code generation...) are nested in the compile's lane.
+        """
+        try:
+            with open(path) as f:
+                events = json.load(f).get("traceEvents", [])
+        except (OSError, ValueError):
+            return
+        for event in events:
+            # per-process totals are summaries, not spans on the timeline
+            if event.get("ph") != "X" or event.get("name", "").startswith("Total "):
+                continue
+            self.events.append(dict(event, pid=self.pid, tid=span["tid"], cat="compiler",
+                                    ts=span["ts"] + event.get("ts", 0)))
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
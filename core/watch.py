@@ -0,0 +1,189 @@
+import os
+import sys
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def is_ignored(name):
+    """Editor swap and backup files never trigger a rebuild."""
+    return name.startswith(".") or name.endswith(("~", ".swp", ".swx", ".tmp"))
+
+
+class BaseWatcher:
+    """
+    Watch files and directory trees for changes.
+
+    ``roots`` are watched recursively, ``files`` individually. ``wait()``
+    blocks until something changed and returns the changed paths, collecting
+    the whole burst of events of one save (debounced by ``debounce`` seconds).
+    """
+    debounce = 0.2
+
+    def __init__(self, roots=(), files=(), ignore=()):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.files = {os.path.abspath(path) for path in files}
+        self.ignore = [os.path.abspath(path) for path in ignore]
+
+    def _is_ignored(self, path):
+        return is_ignored(os.path.basename(path)) or any(
+            path == ignored or path.startswith(ignored + os.sep) for ignored in self.ignore)
+
+    def poll(self, timeout):
+        """Return the paths changed within ``timeout`` seconds (maybe none)."""
+        raise NotImplementedError('subclasses of BaseWatcher must provide a poll() method')
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        changed = set()
+        while not changed:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return changed
+            changed |= self.poll(remaining if remaining is not None else 1.0)
+        # debounce: a save often is several events, wait until they stop
+        while True:
+            more = self.poll(self.debounce)
+            if not more:
+                return changed
+            changed |= more
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(BaseWatcher):
+    """Portable watcher comparing mtimes and sizes on a fixed interval."""
+    interval = 0.5
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for path in self.files:
+            try:
+                st = os.stat(path)
+                snapshot[path] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                pass
+        stack = [root for root in self.roots if os.path.isdir(root)]
+        while stack:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if self._is_ignored(entry.path):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        st = entry.stat()
+                        snapshot[entry.path] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def poll(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        snapshot = self._scan()
+        changed = {path for path in snapshot.keys() | self._snapshot.keys()
+                   if snapshot.get(path) != self._snapshot.get(path)}
+        self._snapshot = snapshot
+        return changed
+
+
+class InotifyWatcher(BaseWatcher):
+    """Linux watcher built on inotify(7) through ctypes."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}
+        self._watched = set()
+        for root in self.roots:
+            self._add_tree(root)
+        for path in self.files:
+            # watch the parent directory so replaced files (editor saves) are seen
+            self._add_dir(os.path.dirname(path))
+
+    def _add_dir(self, path):
+        if path in self._watched:
+            return
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd >= 0:
+            self._dirs[wd] = path
+            self._watched.add(path)
+
+    def _add_tree(self, root):
+        for directory, dirs, _ in os.walk(root):
+            dirs[:] = [name for name in dirs
+                       if not self._is_ignored(os.path.join(directory, name))]
+            self._add_dir(directory)
+
+    def _is_watched(self, path):
+        return path in self.files or any(
+            path == root or path.startswith(root + os.sep) for root in self.roots)
+
+    def poll(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(sys.getfilesystemencoding())
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # events were dropped, report every watched tree as changed
+                changed.update(self.roots)
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name) if name else directory
+            if self._is_ignored(path) or not self._is_watched(path):
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(path)
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+def get_watcher(roots=(), files=(), ignore=()):
+    """Return an inotify watcher on Linux, else a polling watcher."""
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(roots, files, ignore)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(roots, files, ignore)
@@ -0,0 +1,52 @@
+import pytest
+
+from cpm.core.graph import AppGraph
+from cpm.utils.exceptions import AppNotFoundError, DependencyCycleError
+
+
+def apps(depends_on):
+    return [{"name": name, "depends_on": dependencies} for name, dependencies in depends_on.items()]
+
+
+@pytest.mark.parametrize("depends_on, order", [
+    ({"a": [], "b": []}, ["a", "b"]),
+    ({"app": ["util"], "util": []}, ["util", "app"]),
+    ({"app": ["net", "util"], "net": ["util"], "util": []}, ["util", "net", "app"]),
+    ({"a": ["b", "c"], "b": ["d"], "c": ["d"], "d": []}, ["d", "b", "c", "a"]),
+])
+def test_order(depends_on, order):
+    graph = AppGraph(apps(depends_on))
+    assert graph.order == order
+    # a static link names every app before its dependencies
+    assert graph.link_order(order) == order[::-1]
+
+
+@pytest.mark.parametrize("depends_on, cycle", [
+    ({"a": ["a"]}, "a -> a"),
+    ({"a": ["b"], "b": ["a"]}, "a -> b -> a"),
+    ({"app": ["a"], "a": ["b"], "b": ["c"], "c": ["a"]}, "a -> b -> c -> a"),
+])
+def test_cycle(depends_on, cycle):
+    with pytest.raises(DependencyCycleError, match=cycle):
+        AppGraph(apps(depends_on))
+
+
+def test_unknown_dependency():
+    with pytest.raises(AppNotFoundError):
+        AppGraph(apps({"app": ["missing"]}))
+
+
+@pytest.mark.parametrize("name, dependencies", [
+    ("app", ["util", "net"]),
+    ("net", ["util"]),
+    ("util", []),
+])
+def test_dependencies(name, dependencies):
+    graph = AppGraph(apps({"app": ["net"], "net": ["util"], "util": []}))
+    assert graph.dependencies(name) == dependencies
+
+
+def test_critical_path():
+    graph = AppGraph(apps({"app": ["net", "util"], "net": ["util"], "util": [], "tool": []}))
+    seconds, path = graph.critical_path({"app": 1.0, "net": 2.0, "util": 3.0, "tool": 5.0})
+    assert (seconds, path) == (6.0, ["util", "net", "app"])
@@ -0,0 +1,95 @@
+import os
+import time
+
+import pytest
+
+from cpm.core.index import SourceIndex
+
+
+def write(root, *names):
+    for name in names:
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write("")
+
+
+def age(root, seconds=10):
+    """Move the mtime of every directory under ``root`` out of the racy window."""
+    past = time.time() - seconds
+    for directory, _, _ in os.walk(root):
+        os.utime(directory, (past, past))
+
+
+def listed(index, root):
+    return sorted(os.path.relpath(path, root) for path in index.files(root, (".cpp",)))
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = str(tmp_path / "source")
+    write(root, "a.cpp", "b.hpp", "sub/c.cpp", "sub/deep/d.cpp")
+    age(root)
+    return root
+
+
+@pytest.mark.parametrize("change, expected", [
+    (lambda root: None, ["a.cpp", "sub/c.cpp", "sub/deep/d.cpp"]),
+    (lambda root: write(root, "e.cpp"), ["a.cpp", "e.cpp", "sub/c.cpp", "sub/deep/d.cpp"]),
+    (lambda root: write(root, "sub/new/f.cpp"),
+     ["a.cpp", "sub/c.cpp", "sub/deep/d.cpp", "sub/new/f.cpp"]),
+    (lambda root: os.remove(os.path.join(root, "sub", "c.cpp")), ["a.cpp", "sub/deep/d.cpp"]),
+    (lambda root: os.rename(os.path.join(root, "a.cpp"), os.path.join(root, "sub", "a.cpp")),
+     ["sub/a.cpp", "sub/c.cpp", "sub/deep/d.cpp"]),
+    (lambda root: write(root, "notes.txt"), ["a.cpp", "sub/c.cpp", "sub/deep/d.cpp"]),
+])
+def test_changes_are_found(tmp_path, tree, change, expected):
+    build_dir = str(tmp_path / "build")
+    index = SourceIndex(build_dir)
+    listed(index, tree)
+    index.save()
+    change(tree)
+    assert listed(SourceIndex(build_dir), tree) == [path.replace("/", os.sep) for path in expected]
+
+
+def test_unchanged_tree_is_not_listed_again(tmp_path, tree):
+    build_dir = str(tmp_path / "build")
+    index = SourceIndex(build_dir)
+    listed(index, tree)
+    index.save()
+    index = SourceIndex(build_dir)
+    listed(index, tree)
+    assert not index.changed
+
+
+def test_racy_directory_is_listed_again(tmp_path, tree):
+    build_dir = str(tmp_path / "build")
+    index = SourceIndex(build_dir)
+    write(tree, "e.cpp")
+    st = os.stat(tree)
+    listed(index, tree)
+    index.save()
+    # a change within the same mtime tick leaves the mtime as it was
+    write(tree, "f.cpp")
+    os.utime(tree, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert "f.cpp" in listed(SourceIndex(build_dir), tree)
+
+
+def test_removed_directories_are_forgotten(tmp_path, tree):
+    index = SourceIndex(str(tmp_path / "build"))
+    listed(index, tree)
+    deep = os.path.join(tree, "sub", "deep")
+    assert deep in index.dirs
+    os.remove(os.path.join(deep, "d.cpp"))
+    os.rmdir(deep)
+    assert listed(index, tree) == ["a.cpp", os.path.join("sub", "c.cpp")]
+    assert deep not in index.dirs
+
+
+def test_other_version_is_ignored(tmp_path, tree, monkeypatch):
+    build_dir = str(tmp_path / "build")
+    index = SourceIndex(build_dir)
+    listed(index, tree)
+    index.save()
+    monkeypatch.setattr(SourceIndex, "version", SourceIndex.version + 1)
+    assert SourceIndex(build_dir).dirs == {}
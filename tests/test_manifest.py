@@ -0,0 +1,20 @@
+import pytest
+
+from cpm.core.manifest import parse_depfile
+
+
+@pytest.mark.parametrize("content, expected", [
+    ("m.o: m.cpp a.hpp\n", ["m.cpp", "a.hpp"]),
+    ("m.o: m.cpp \\\n a.hpp \\\n b.hpp\n", ["m.cpp", "a.hpp", "b.hpp"]),
+    ("m.o: m.cpp a\\ b/x.hpp\n", ["m.cpp", "a b/x.hpp"]),
+    ("m.o: m.cpp x\\#1.hpp\n", ["m.cpp", "x#1.hpp"]),
+    ("m.o: m.cpp c$$d.hpp\n", ["m.cpp", "c$d.hpp"]),
+    ("m.o: D:\\proj\\main.cpp \\\n D:\\proj\\util\\include\\u.hpp\n",
+     ["D:\\proj\\main.cpp", "D:\\proj\\util\\include\\u.hpp"]),
+    ("m.o: m.cpp\n\nother.o: other.cpp\n", ["m.cpp"]),
+    ("m.o:\n", []),
+])
+def test_parse_depfile(tmp_path, content, expected):
+    depfile = tmp_path / "m.d"
+    depfile.write_text(content)
+    assert parse_depfile(str(depfile)) == expected
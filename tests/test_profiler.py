@@ -0,0 +1,82 @@
+import pytest
+
+from cpm.core.profiler import parse_gprof_call_graph, parse_gprof_flat, parse_perf_report
+
+GPROF_FLAT = """\
+Flat profile:
+
+Each sample counts as 0.01 seconds.
+  %   cumulative   self              self     total
+ time   seconds   seconds    calls  ms/call  ms/call  name
+100.16      1.83     1.83       40    45.83    45.83  work(long)
+  0.00      1.83     0.00       20     0.00    91.65  more(long)
+"""
+
+GPROF_CALL_GRAPH = """\
+\t\t\tCall graph
+
+
+granularity: each sample hit covers 2 byte(s) for 0.55% of 1.83 seconds
+
+index % time    self  children    called     name
+                                                 <spontaneous>
+[1]    100.0    0.00    1.83                 main [1]
+                0.00    1.83      20/20          more(long) [3]
+-----------------------------------------------
+                1.83    0.00      40/40          more(long) [3]
+[2]     95.0    1.83    0.00      40         work(long) [2]
+-----------------------------------------------
+                0.00    1.83      20/20          main [1]
+[3]     99.0    0.00    1.83      20         more(long) [3]
+                1.83    0.00      40/40          work(long) [2]
+-----------------------------------------------
+
+Index by function name
+
+   [3] more(long)              [2] work(long)
+"""
+
+PERF_REPORT = """\
+# Samples: 1K of event 'cpu-clock:pppH'
+#
+# Children      Self  Symbol
+# ........  ........  ..............................
+#
+    99.12%     0.00%  [.] main
+    95.30%    95.30%  [.] work(long)
+     3.10%     3.10%  [k] clear_page_erms
+            |
+            ---main
+"""
+
+
+@pytest.mark.parametrize("output, expected", [
+    (GPROF_FLAT, [(100.16, 1.83, 40, "work(long)"), (0.0, 0.0, 20, "more(long)")]),
+    # functions compiled without -pg have no call count
+    (" 12.50      0.20     0.20                             frame_dummy\n",
+     [(12.5, 0.2, None, "frame_dummy")]),
+    ("Flat profile:\n\nno time accumulated\n", []),
+])
+def test_parse_gprof_flat(output, expected):
+    assert parse_gprof_flat(output) == expected
+
+
+@pytest.mark.parametrize("output, expected", [
+    (GPROF_CALL_GRAPH, [(100.0, 0.0, 1.83, "main"), (99.0, 0.0, 1.83, "more(long)"),
+                        (95.0, 1.83, 0.0, "work(long)")]),
+    # recursive calls are counted as "calls+recursive"
+    ("[4]     50.0    0.10    0.40       3+5       walk(Node*) [4]\n",
+     [(50.0, 0.1, 0.4, "walk(Node*)")]),
+    ("", []),
+])
+def test_parse_gprof_call_graph(output, expected):
+    assert parse_gprof_call_graph(output) == expected
+
+
+@pytest.mark.parametrize("output, expected", [
+    (PERF_REPORT, [(99.12, 0.0, "main"), (95.3, 95.3, "work(long)"),
+                   (3.1, 3.1, "clear_page_erms")]),
+    ("# no samples\n", []),
+])
+def test_parse_perf_report(output, expected):
+    assert parse_perf_report(output) == expected
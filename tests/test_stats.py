@@ -0,0 +1,49 @@
+import math
+
+import pytest
+
+from cpm.core.stats import compare, summarize, t_quantile
+
+
+# exact quantiles of Student's t distribution
+@pytest.mark.parametrize("p, df, expected", [
+    (0.975, 1, 12.7062),
+    (0.975, 2, 4.3027),
+    (0.975, 3, 3.1824),
+    (0.975, 5, 2.5706),
+    (0.975, 10, 2.2281),
+    (0.975, 30, 2.0423),
+    (0.975, 1000, 1.9623),
+    (0.95, 4, 2.1318),
+    (0.025, 10, -2.2281),
+])
+def test_t_quantile(p, df, expected):
+    assert t_quantile(p, df) == pytest.approx(expected, rel=0.005)
+
+
+@pytest.mark.parametrize("baseline, candidate, difference, change, significant", [
+    ([1, 1, 1], [1, 1, 1], 0, 0.0, False),
+    ([1, 1, 1], [2, 2, 2], 1, 1.0, True),
+    ([10, 11, 9, 10, 10], [20, 21, 19, 20, 20], 10, 1.0, True),
+    ([10, 12, 8], [11, 9, 13], 1, 0.1, False),
+    # a single run has no variance: the difference is never significant
+    ([10], [12, 13], 2.5, 0.25, False),
+])
+def test_compare(baseline, candidate, difference, change, significant):
+    result = compare(baseline, candidate)
+    assert result["difference"] == pytest.approx(difference)
+    assert result["change"] == pytest.approx(change)
+    assert result["significant"] is significant
+    low, high = result["ci"]
+    assert low <= result["difference"] <= high
+
+
+@pytest.mark.parametrize("values, mean, median, ci", [
+    ([1, 2, 3, 4], 2.5, 2.5, (0.4482, 4.5518)),
+    ([5], 5, 5, (-math.inf, math.inf)),
+])
+def test_summarize(values, mean, median, ci):
+    result = summarize(values)
+    assert result["mean"] == pytest.approx(mean)
+    assert result["median"] == pytest.approx(median)
+    assert result["ci"] == pytest.approx(list(ci), rel=0.001)
@@ -8,17 +8,18 @@ class ExecutionTime(object):
         self.execution_time = None
 
     def start(self):
-        self.start_time = time.time()
+        self.start_time = time.perf_counter()
 
     def end(self):
-        self.end_time = time.time()
+        self.end_time = time.perf_counter()
 
     def _time_color(self):
         return colorize(self.get_execution_time(), "green")
     
     def timeformat(self, total_time):
+        # total_time is in seconds, sub-second times are shown in milliseconds
         if int(total_time) == 0:
-            return colorize("%0.3fms" % total_time, fg="green", opts=("underscore",))
+            return colorize("%0.3fms" % (total_time * 1000), fg="green", opts=("underscore",))
         return colorize("%0.3fs" % total_time, fg="green", opts=("underscore",))
     
     def get_execution_time(self):
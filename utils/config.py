@@ -1,9 +1,20 @@
 import os
-from pathlib import Path
 
 __current_path__ = os.getcwd()
 __search_file__ = "cpm.json"
 __folder_name__ = "cpm"
 __cpm_ascii_file__ = "cpmIcon.txt"
-__base_path__ = BASE_DIR = Path(__file__).resolve().parent.parent
+# os.path rather than pathlib: this module is imported on every cpm start
+__base_path__ = BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def default_cache_dir():
+    """
+    Return the cache directory of cpm, which holds the shared object cache:
+    ``$CPM_CACHE_DIR``, else ``$XDG_CACHE_HOME/cpm``, else ``~/.cache/cpm``.
+    """
+    if os.environ.get("CPM_CACHE_DIR"):
+        return os.path.abspath(os.path.expanduser(os.environ["CPM_CACHE_DIR"]))
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "cpm")
 
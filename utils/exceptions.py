@@ -35,3 +35,7 @@ class KeyWordNotFoundError(CommandError):
 
 class CompileError(CommandError):
     pass
+
+
+class DependencyCycleError(CommandError):
+    pass